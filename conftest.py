@@ -0,0 +1,22 @@
+"""Skip the doctests needing optional dependencies that aren't installed"""
+
+import importlib.util
+
+import pytest
+
+has_numpy = importlib.util.find_spec('numpy') is not None
+
+# modules that can't even be imported without them
+collect_ignore = [] if has_numpy else ['embody/columnar.py']
+
+# doctests of other modules that use them
+_numpy_doctests = {'embody.compiled.CompiledTemplate.render_columns'}
+
+
+def pytest_collection_modifyitems(config, items):
+    if has_numpy:
+        return
+    skip_numpy = pytest.mark.skip(reason='needs numpy (the columnar extra)')
+    for item in items:
+        if item.name in _numpy_doctests:
+            item.add_marker(skip_numpy)
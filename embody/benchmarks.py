@@ -0,0 +1,167 @@
+"""Timing the templater backends on wide and deep templates
+
+Run ``python -m embody.benchmarks`` to print a comparison table.
+
+>>> t = mk_wide_template(3)
+>>> t['field_2']
+'{field_2}'
+>>> kwargs = kwargs_for(t)
+>>> sorted(kwargs)
+['field_0', 'field_1', 'field_2']
+>>> timings = compare_backends({'wide': t}, number=1)
+>>> sorted(timings['wide'])
+['closure', 'codegen', 'plan']
+>>> sorted(compare_compile_times(n_fields=10, backends=['plan']))
+['deep', 'wide']
+"""
+
+import json
+import timeit
+from typing import Dict, Iterable, Mapping
+
+from embody.templater import Templater
+
+DFLT_BACKENDS = ('closure', 'plan', 'codegen')
+
+
+def mk_wide_template(n_fields: int = 200, static_every: int = 2) -> dict:
+    """A flat dict of ``n_fields`` templated values, with static entries interleaved"""
+    template = {}
+    for i in range(n_fields):
+        template[f'field_{i}'] = f'{{field_{i}}}'
+        if static_every and i % static_every == 0:
+            template[f'static_{i}'] = [i, 'static', {'flag': True}]
+    return template
+
+
+def mk_deep_template(depth: int = 50, width: int = 3) -> dict:
+    """Dicts and lists nested ``depth`` levels deep, with templated strings at every
+    level"""
+    template = {'leaf': '{level_0}'}
+    for level in range(1, depth):
+        items = [f'{{level_{level}}} #{j}' for j in range(width)]
+        child = [template] if level % 2 else template
+        template = {'level': level, 'name': f'{{level_{level}}}', 'items': items}
+        template['child'] = child
+    return template
+
+
+def mk_mostly_static_template(n_sections: int = 20, static_ratio: int = 9) -> dict:
+    """A configuration-like template where only one section in ``static_ratio + 1``
+    has templated values"""
+    template = {}
+    for i in range(n_sections):
+        if i % (static_ratio + 1) == 0:
+            template[f'section_{i}'] = {'name': f'{{name_{i}}}', 'tags': ['{env}']}
+        else:
+            template[f'section_{i}'] = {
+                'name': f'section {i}',
+                'tags': ['static', 'config'],
+                'options': {'retries': 3, 'timeout': 1.5, 'hosts': ['a', 'b']},
+            }
+    return template
+
+
+def kwargs_for(template, backend='plan') -> dict:
+    """Some kwargs covering all the parameters of ``template``"""
+    g = Templater.template_func(template, backend=backend)
+    return {name: name.upper() for name in g.__signature__.parameters}
+
+
+def time_render(template, backend: str, number: int = 1000) -> float:
+    """Seconds per render of ``template`` with ``backend``"""
+    g = Templater.template_func(template, backend=backend)
+    kwargs = kwargs_for(template)
+    return timeit.timeit(lambda: g(**kwargs), number=number) / number
+
+
+def time_compile(template, backend: str) -> float:
+    """Seconds to make the template function of ``template`` with ``backend``"""
+    return timeit.timeit(
+        lambda: Templater.template_func(template, backend=backend), number=1
+    )
+
+
+def compare_compile_times(
+    n_fields: int = 10000, backends: Iterable[str] = ('plan', 'codegen')
+) -> Dict[str, Dict[str, float]]:
+    """Seconds to compile a wide and a deep template with ``n_fields`` distinct
+    fields, for each backend (the closure backend recurses, so can't compile the
+    deep one past a few hundred levels)"""
+    templates = {
+        'wide': mk_wide_template(n_fields),
+        'deep': mk_deep_template(n_fields, width=1),
+    }
+    return {
+        name: {backend: time_compile(t, backend) for backend in backends}
+        for name, t in templates.items()
+    }
+
+
+def time_json_render(template, number: int = 1000) -> dict:
+    """Seconds per json render, with ``json.dumps`` of the renders of the ``'plan'``
+    and ``'codegen'`` backends, and with the ``'json'`` backend"""
+    kwargs = kwargs_for(template)
+    timings = {}
+    for backend in ('plan', 'codegen'):
+        g = Templater.template_func(template, backend=backend)
+        timings[backend] = (
+            timeit.timeit(lambda: json.dumps(g(**kwargs)), number=number) / number
+        )
+    g = Templater.template_func(template, backend='json')
+    timings['json'] = timeit.timeit(lambda: g(**kwargs), number=number) / number
+    return timings
+
+
+def time_render_many(template, backend: str = 'plan', n_rows: int = 10000) -> dict:
+    """Seconds per row, rendering ``n_rows`` rows with python loops of calls (with
+    kwargs and ``from_tuple``), and with ``render_many`` on dict rows, tuple rows and
+    columns"""
+    g = Templater.template_func(template, backend=backend)
+    kwargs = kwargs_for(template)
+    dict_rows = [kwargs] * n_rows
+    tuple_rows = [tuple(kwargs[name] for name in g.params)] * n_rows
+    columns = {name: [value] * n_rows for name, value in kwargs.items()}
+
+    def timed(func):
+        return timeit.timeit(func, number=1) / n_rows
+
+    return {
+        'loop': timed(lambda: [g(**row) for row in dict_rows]),
+        'from_tuple': timed(lambda: [g.from_tuple(row) for row in tuple_rows]),
+        'dicts': timed(lambda: list(g.render_many(dict_rows))),
+        'tuples': timed(lambda: list(g.render_many(tuple_rows))),
+        'columns': timed(lambda: list(g.render_many(columns))),
+    }
+
+
+def compare_backends(
+    templates: Mapping[str, object] = None,
+    backends: Iterable[str] = DFLT_BACKENDS,
+    number: int = 1000,
+) -> Dict[str, Dict[str, float]]:
+    """Seconds per render, for each template (name) and backend"""
+    if templates is None:
+        templates = {
+            'wide': mk_wide_template(),
+            'deep': mk_deep_template(),
+            'static': mk_mostly_static_template(),
+        }
+    return {
+        name: {backend: time_render(t, backend, number) for backend in backends}
+        for name, t in templates.items()
+    }
+
+
+def print_comparison(timings: Mapping[str, Mapping[str, float]]):
+    for name, backend_timings in timings.items():
+        baseline = next(iter(backend_timings.values()))
+        for backend, seconds in backend_timings.items():
+            print(
+                f'{name:>10} {backend:>10} {seconds * 1e6:10.2f} us'
+                f' {baseline / seconds:6.2f}x'
+            )
+
+
+if __name__ == '__main__':
+    print_comparison(compare_backends())
@@ -0,0 +1,281 @@
+"""Generate (and compile) python source code rendering a template
+
+The render plan of ``embody.compiled`` is turned into the source of a single
+function whose body is one expression: dict and list literals, with f-strings in
+place of the format strings.
+
+>>> from embody.compiled import Compiler
+>>> template = {
+...     'hello': '{name}',
+...     'how are you': ['{verb}', 2, '{name} and {verb} again']
+... }
+>>> print(render_source(Compiler.compile(template)), end='')
+def render(kwargs):
+    return {'hello': f"{kwargs['name']}", 'how are you': [f"{kwargs['verb']}", 2, f"{kwargs['name']} and {kwargs['verb']} again"]}
+>>> render = codegen_render(Compiler.compile(template))
+>>> render({'name': 'NAME', 'verb': 'VERB'})
+{'hello': 'NAME', 'how are you': ['VERB', 2, 'NAME and VERB again']}
+
+Field names with attributes, indices, conversions and format specs are kept in
+the f-strings:
+
+>>> render = codegen_render(Compiler.compile('{x.real!r:>6} {y[0]:.2f}'))
+>>> render({'x': 3, 'y': [1.234]})
+'     3 1.23'
+"""
+
+import keyword
+import math
+import string
+from contextlib import contextmanager
+from functools import partial
+from itertools import count
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+from embody.compiled import (
+    Node,
+    Const,
+    ConstCopy,
+    ConstructNode,
+    FormatStr,
+    DictNode,
+    ListNode,
+    LoopNode,
+    Param,
+    Kwargs,
+    plan_render,
+    render_arguments,
+)
+from embody.format_strings import split_field_name
+
+# past this depth, subtrees are rendered by their plan nodes, to stay clear of the
+# parser's nesting limits
+MAX_EXPR_DEPTH = 50
+
+_literal_types = (str, bytes, int, bool, type(None))
+_codegen_file_ids = count()
+
+
+class SourceBuilder:
+    """Accumulates the expression source of plan nodes, and the namespace of the
+    objects that can't be written as literals.
+
+    :param argument: What the render function takes: ``'kwargs'`` (a mapping of the
+        parameter values), ``'tuple'`` (a sequence of the values, ordered like
+        ``params``) or ``'record'`` (an object with the parameters as attributes)
+    :param params: The parameters of the template, in signature order
+
+    >>> SourceBuilder('tuple', params=['x', 'y']).param_expr('y')
+    'row[1]'
+    >>> SourceBuilder('record', params=['x', 'y']).param_expr('y')
+    'row.y'
+    """
+
+    def __init__(self, argument: str = 'kwargs', params: Sequence[str] = ()):
+        if argument not in render_arguments:
+            raise ValueError(f'argument should be in {list(render_arguments)}')
+        self.argument = argument
+        self.params = tuple(params)
+        self.arg_name = 'kwargs' if argument == 'kwargs' else 'row'
+        self.namespace: Dict[str, Any] = {}
+        self._param_index = {param: i for i, param in enumerate(self.params)}
+        self._kwargs_expr = 'kwargs' if argument == 'kwargs' else None
+        # the (item parameter, variable) of the loops the expressions are in
+        self._item_scopes: List[Tuple[str, str]] = []
+
+    def bind(self, obj) -> str:
+        name = f'_obj{len(self.namespace)}'
+        self.namespace[name] = obj
+        return name
+
+    def param_expr(self, name: str) -> str:
+        """The expression of the value of parameter ``name``"""
+        for item, variable in reversed(self._item_scopes):
+            if name == item:
+                return variable
+        if self.argument == 'kwargs':
+            return f'kwargs[{name!r}]'
+        elif self.argument == 'tuple':
+            return f'row[{self._param_index[name]}]'
+        return f'row.{name}' if name.isidentifier() else f'getattr(row, {name!r})'
+
+    def kwargs_expr(self) -> str:
+        """The expression of the kwargs mapping, for the parts rendered by plan
+        nodes"""
+        if self._kwargs_expr is None:
+            to_kwargs = partial(render_arguments[self.argument], self.params)
+            self._kwargs_expr = f'{self.bind(to_kwargs)}(row)'
+        kwargs_expr = self._kwargs_expr
+        for item, variable in self._item_scopes:
+            kwargs_expr = f'{{**{kwargs_expr}, {item!r}: {variable}}}'
+        return kwargs_expr
+
+    @contextmanager
+    def item_scope(self, item: str):
+        """Within it, ``item`` is the variable it yields (of a comprehension)"""
+        variable = f'_item{len(self._item_scopes)}'
+        self._item_scopes.append((item, variable))
+        try:
+            yield variable
+        finally:
+            self._item_scopes.pop()
+
+    def expr(self, node: Node, depth: int = 0) -> str:
+        expr_of_node = codegen_exprs.get(type(node))
+        if expr_of_node is None or depth > MAX_EXPR_DEPTH:
+            # rendered by the plan (with an explicit stack, if it's very deep)
+            return f'{self.bind(plan_render(node))}({self.kwargs_expr()})'
+        return expr_of_node(self, node, depth)
+
+
+def _const_expr(builder: SourceBuilder, node: Const, depth: int) -> str:
+    value = node.value
+    if type(value) in _literal_types or (type(value) is float and math.isfinite(value)):
+        return repr(value)
+    return builder.bind(value)
+
+
+def _const_copy_expr(builder: SourceBuilder, node: ConstCopy, depth: int) -> str:
+    return f'{builder.bind(node.copier)}({builder.bind(node.value)})'
+
+
+def _field_expr(builder: SourceBuilder, field_name: str):
+    """The python expression of a format field, or None if it can't be written
+    in an f-string.
+
+    >>> _field_expr(SourceBuilder(), 'user.name')
+    "kwargs['user'].name"
+    >>> _field_expr(SourceBuilder(), 'rows[0][key]')
+    "kwargs['rows'][0]['key']"
+    >>> _field_expr(SourceBuilder(), 'x.class') is None  # not valid python
+    True
+    """
+    param, path = split_field_name(field_name)
+    parts = [builder.param_expr(param)]
+    for is_attr, key in path:
+        if is_attr:
+            if not key.isidentifier() or keyword.iskeyword(key):
+                return None
+            parts.append(f'.{key}')
+        else:
+            parts.append(f'[{key!r}]')
+    expr = ''.join(parts)
+    # f-string expressions can't hold backslashes or the quote delimiting them
+    if '\\' in expr or '"' in expr:
+        return None
+    return expr
+
+
+def _fstring_literal(text: str) -> str:
+    text = text.encode('unicode_escape').decode('ascii').replace('"', '\\"')
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def _is_plain_format_spec(format_spec: str) -> bool:
+    """Whether the format spec can be copied verbatim in an f-string"""
+    return format_spec.isprintable() and not any(c in format_spec for c in '{"\\')
+
+
+def _format_str_expr(builder: SourceBuilder, node: FormatStr, depth: int) -> str:
+    parts: List[str] = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(
+        node.template
+    ):
+        parts.append(_fstring_literal(literal))
+        if field_name is None:
+            continue
+        expr = _field_expr(builder, field_name)
+        if expr is None or not _is_plain_format_spec(format_spec):
+            return f'{builder.bind(node.template)}.format_map({builder.kwargs_expr()})'
+        conversion = f'!{conversion}' if conversion else ''
+        format_spec = f':{_fstring_literal(format_spec)}' if format_spec else ''
+        parts.append(f'{{{expr}{conversion}{format_spec}}}')
+    return 'f"' + ''.join(parts) + '"'
+
+
+def _param_expr(builder: SourceBuilder, node: Param, depth: int) -> str:
+    return builder.param_expr(node.name)
+
+
+def _dict_expr(builder: SourceBuilder, node: DictNode, depth: int) -> str:
+    items = ', '.join(
+        f'{builder.expr(k, depth + 1)}: {builder.expr(v, depth + 1)}'
+        for k, v in node.items
+    )
+    return '{' + items + '}'
+
+
+def _list_expr(builder: SourceBuilder, node: ListNode, depth: int) -> str:
+    return '[' + ', '.join(builder.expr(item, depth + 1) for item in node.items) + ']'
+
+
+def _construct_expr(builder: SourceBuilder, node: ConstructNode, depth: int) -> str:
+    items = [builder.expr(item, depth + 1) for item in node.items]
+    if node.make is tuple:
+        return '(' + ', '.join(items) + (',' if len(items) == 1 else '') + ')'
+    elif node.make is set and items:
+        return '{' + ', '.join(items) + '}'
+    return f'{builder.bind(node.make)}([' + ', '.join(items) + '])'
+
+
+def _loop_expr(builder: SourceBuilder, node: LoopNode, depth: int) -> str:
+    values = builder.param_expr(node.param)
+    with builder.item_scope(node.item) as variable:
+        item = builder.expr(node.node, depth + 1)
+    return f'[{item} for {variable} in {values}]'
+
+
+codegen_exprs: Dict[type, Callable[[SourceBuilder, Node, int], str]] = {
+    Const: _const_expr,
+    ConstCopy: _const_copy_expr,
+    FormatStr: _format_str_expr,
+    Param: _param_expr,
+    DictNode: _dict_expr,
+    ListNode: _list_expr,
+    ConstructNode: _construct_expr,
+    LoopNode: _loop_expr,
+}
+
+
+def _render_source_and_namespace(root: Node, argument: str = 'kwargs'):
+    builder = SourceBuilder(argument, root.params)
+    expr = builder.expr(root)
+    return render_function_source(expr, builder.arg_name), builder.namespace
+
+
+def render_function_source(expr: str, arg_name: str = 'kwargs') -> str:
+    return f'def render({arg_name}):\n    return {expr}\n'
+
+
+def compile_render_function(source: str, namespace: dict) -> Callable[[Kwargs], Any]:
+    """Compile the ``source`` of a ``render`` function, in ``namespace``"""
+    filename = f'<embody codegen {next(_codegen_file_ids)}>'
+    exec(compile(source, filename, 'exec'), namespace)
+    render = namespace['render']
+    render.source = source
+    return render
+
+
+def render_source(root: Node, argument: str = 'kwargs') -> str:
+    """The source code of the function rendering the plan of ``root``"""
+    source, _ = _render_source_and_namespace(root, argument)
+    return source
+
+
+def codegen_render(root: Node, *, argument: str = 'kwargs') -> Callable[[Any], Any]:
+    """Make a function rendering the plan of ``root`` by generating its source and
+    compiling it.
+
+    By default, the function renders from a kwargs mapping, but it can also take
+    a tuple of values ordered like the parameters, or a record having them as
+    attributes (see ``SourceBuilder``):
+
+    >>> from embody.compiled import Compiler
+    >>> root = Compiler.compile({'id': '{id}', 'label': '{name}-{id}'})
+    >>> print(render_source(root, 'tuple'), end='')
+    def render(row):
+        return {'id': f"{row[0]}", 'label': f"{row[1]}-{row[0]}"}
+    >>> codegen_render(root, argument='tuple')((1, 'a'))
+    {'id': '1', 'label': 'a-1'}
+    """
+    return compile_render_function(*_render_source_and_namespace(root, argument))
@@ -0,0 +1,151 @@
+"""Render templates column-wise, over tables of parameter values (needs numpy)
+
+Rendering a template for every row of a table calls ``str.format`` once per string
+leaf and row. Here, the string leaves are rendered a column at a time instead: the
+values of each field are converted to strings by numpy (for arrays of numbers,
+booleans or strings) and concatenated with the literal segments of the format
+string, giving one array per leaf. The arrays are assembled into records only at
+the end, or returned as they are.
+
+>>> import numpy as np
+>>> from embody.compiled import Compiler
+>>> root = Compiler.compile({'id': 'user-{id}', 'tags': ['{id}', 'static']})
+>>> render_columns(root, {'id': np.arange(3)})
+[{'id': 'user-0', 'tags': ['0', 'static']}, {'id': 'user-1', 'tags': ['1', 'static']}, {'id': 'user-2', 'tags': ['2', 'static']}]
+>>> leaf_columns = render_columns(root, {'id': np.arange(3)}, records=False)
+>>> {path: column.tolist() for path, column in leaf_columns.items()}
+{('id',): ['user-0', 'user-1', 'user-2'], ('tags', 0): ['0', '1', '2']}
+
+pandas columns (``Series``, or a ``DataFrame`` as the mapping of columns) work too,
+through their numpy arrays.
+"""
+
+from typing import List, Tuple
+
+import numpy as np
+
+from embody.compiled import (
+    Node,
+    DictNode,
+    ListNode,
+    FormatStr,
+    Param,
+    _output_slots,
+)
+from embody.codegen import codegen_render
+from embody.format_strings import parse_format_string
+
+# numpy>=2 has ufuncs on strings in np.strings, older versions in np.char
+_str_add = getattr(np, 'strings', np.char).add
+
+# dtype kinds whose numpy str conversion is python's (float64 repr included)
+_vectorized_kinds = frozenset('biuU')
+
+
+def _values(column):
+    to_numpy = getattr(column, 'to_numpy', None)  # pandas
+    return to_numpy() if to_numpy is not None else column
+
+
+def _str_column(values):
+    """The ``format(value)`` of every value of ``values``, as an array of strings"""
+    if isinstance(values, np.ndarray) and (
+        values.dtype.kind in _vectorized_kinds or values.dtype == np.float64
+    ):
+        return values.astype(str)
+    # lists, object arrays...: numpy could coerce mixed types (e.g. 1 to '1.0')
+    return np.array(list(map(format, values)), dtype=str)
+
+
+def _field_column(field, columns):
+    if not field.path and field.conversion is None and field.format_spec == '':
+        return _str_column(_values(columns[field.param]))
+    # attributes, indices, conversions and format specs: format each value
+    names = field.params
+    rows = zip(*(_values(columns[name]) for name in names))
+    return np.array([field.render(dict(zip(names, row))) for row in rows], dtype=str)
+
+
+def format_str_column(node: FormatStr, columns):
+    """The renders of ``node`` for all the rows of ``columns``, as an array"""
+    result = None
+    for segment in parse_format_string(node.template):
+        if not isinstance(segment, str):
+            segment = _field_column(segment, columns)
+        result = segment if result is None else _str_add(result, segment)
+    return result
+
+
+def leaf_column(node: Node, columns):
+    """The renders of ``node`` for all the rows of ``columns``: an array of strings
+    for format strings, the column itself for a whole-value ``Param``, and a list of
+    renders (made row by row) for other nodes"""
+    if type(node) is FormatStr:
+        return format_str_column(node, columns)
+    elif type(node) is Param:
+        return _values(columns[node.name])
+    names = node.params
+    rows = zip(*(_values(columns[name]) for name in names))
+    return [node.render(dict(zip(names, row))) for row in rows]
+
+
+def _leaves_to_params(node: Node, leaves: List[Tuple[tuple, Node]], path=()) -> Node:
+    """Replace the templated leaves of ``node`` by params named after their index
+    in ``leaves``, where they're appended with their path"""
+    if not node.has_params:
+        return node
+    slots = _output_slots(node)
+    if slots is None:
+        leaves.append((path, node))
+        return Param(f'_leaf{len(leaves) - 1}')
+    children = [_leaves_to_params(child, leaves, path + (key,)) for key, child in slots]
+    if type(node) is DictNode:
+        return DictNode(zip((k for k, _ in node.items), children))
+    return ListNode(children)
+
+
+def _n_rows(columns, names) -> int:
+    lengths = {len(_values(columns[name])) for name in names}
+    if len(lengths) > 1:
+        raise ValueError(f'Columns should all have the same length: {lengths}')
+    return lengths.pop() if lengths else 0
+
+
+def render_columns(root: Node, columns, *, records: bool = True):
+    """Render the plan of ``root`` for every row of ``columns``, a mapping of
+    parameter names to equal-length columns of values (arrays, lists, pandas
+    series...), rendering each templated leaf a whole column at a time.
+
+    :param root: The root node of the plan
+    :param columns: The columns of parameter values
+    :param records: If true (default), return the list of renders, else a dict
+        mapping the path of each templated leaf (see ``dependency_index``) to its
+        column of renders
+
+    Leaves are the parts of the render that aren't dicts (with static keys) or
+    lists: format strings are rendered by numpy, other leaves (e.g. tuples) row by
+    row.
+
+    >>> from embody.compiled import Compiler
+    >>> root = Compiler.compile({'point': ('{x}', '{y}'), 'label': '{x:.1f}'})
+    >>> render_columns(root, {'x': [1.0, 2.5], 'y': [3, 4]})
+    [{'point': ('1.0', '3'), 'label': '1.0'}, {'point': ('2.5', '4'), 'label': '2.5'}]
+    """
+    n_rows = _n_rows(columns, root.params or list(columns))
+    leaves: List[Tuple[tuple, Node]] = []
+    leaves_root = _leaves_to_params(root, leaves)
+    leaf_columns = [leaf_column(node, columns) for _, node in leaves]
+    if not records:
+        return {path: column for (path, _), column in zip(leaves, leaf_columns)}
+    if not leaves:
+        return [root.render({}) for _ in range(n_rows)]
+    render = codegen_render(leaves_root, argument='tuple')
+    leaf_values = [
+        column.tolist() if _is_str_array(column) else column for column in leaf_columns
+    ]
+    return list(map(render, zip(*leaf_values)))
+
+
+def _is_str_array(column) -> bool:
+    # arrays of strings hold numpy strings: records should have python ones
+    return isinstance(column, np.ndarray) and column.dtype.kind == 'U'
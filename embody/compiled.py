@@ -0,0 +1,2320 @@
+"""Compile templates into render plans
+
+``Templater.template_func`` builds a tree of closures where every node slices its
+own kwargs out of its parent's and calls its children with ``**kwargs``.
+Here, a template is compiled once into a tree of slotted nodes that all render
+against the same kwargs mapping, so a render does no per-node re-slicing.
+
+>>> from embody.compiled import CompiledTemplate
+>>> template = {
+...     'hello': '{name}',
+...     'how are you': ['{verb}', 2, '{name} and {verb} again']
+... }
+>>> g = CompiledTemplate(template)
+>>> g(name='NAME', verb="VERB")
+{'hello': 'NAME', 'how are you': ['VERB', 2, 'NAME and VERB again']}
+>>> str(g.__signature__)
+'(*, name, verb)'
+
+The plan itself is a tree of nodes, each knowing the parameters it depends on:
+
+>>> g.root  # doctest: +NORMALIZE_WHITESPACE
+DictNode(((Const('hello'), FormatStr('{name}')),
+          (Const('how are you'),
+           ListNode((FormatStr('{verb}'), Const(2),
+                     FormatStr('{name} and {verb} again'))))))
+>>> g.root.params
+('name', 'verb')
+
+A plan can also be rendered from a mapping directly, skipping the ``**kwargs``
+packing:
+
+>>> g.render({'name': 'Bob', 'verb': 'run'})['hello']
+'Bob'
+"""
+
+import asyncio
+import json
+import math
+import operator
+import os
+import string
+from abc import ABC, ABCMeta
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy as shallow_copy
+from dataclasses import fields, is_dataclass
+from functools import lru_cache, partial, wraps
+from inspect import Signature, Parameter, isawaitable
+from itertools import chain, islice, repeat
+from time import perf_counter
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from embody.format_strings import Kwargs, format_string_func, format_string_params
+
+
+class Node:
+    """Base of render plan nodes.
+
+    ``params`` holds the (ordered, unique) names of the parameters the node's
+    subtree uses, and ``render`` takes the full kwargs mapping of the render.
+    Containers collect their ``params`` lazily, in a single walk of their subtree
+    (see ``collect_params``), so compiling stays linear in the size of the template
+    however deep it is; ``has_params`` tells if there are any, at no cost.
+    Nodes with child nodes expose them with ``children``, and make a copy of
+    themselves with other children with ``with_children``, so passes over the plan
+    (e.g. ``fold_constants``) can be written once for all node types. Containers
+    also ``assemble`` their render from the renders of their children, so plans too
+    deep to render recursively can be rendered with an explicit stack (see
+    ``iterative_render``).
+    """
+
+    __slots__ = ('_params', 'has_params')
+    assemble: Optional[Callable[[list], Any]] = None
+
+    @property
+    def params(self) -> Tuple[str, ...]:
+        if self._params is None:
+            self._params = collect_params(self)
+        return self._params
+
+    @params.setter
+    def params(self, params: Tuple[str, ...]):
+        self._params = params
+        self.has_params = bool(params)
+
+    def _set_children_params(self, children: Iterable['Node']):
+        """For containers: params are collected when first needed"""
+        self._params = None
+        self.has_params = any(child.has_params for child in children)
+
+    def render(self, kwargs: Kwargs):
+        raise NotImplementedError
+
+    def children(self) -> Tuple['Node', ...]:
+        return ()
+
+    def with_children(self, children: Iterable['Node']) -> 'Node':
+        return self
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self._repr_arg()!r})'
+
+    def _repr_arg(self):
+        raise NotImplementedError
+
+
+def collect_params(root: Node) -> Tuple[str, ...]:
+    """The (ordered, unique) names of the parameters of the plan of ``root``, in a
+    single walk (reusing the ``params`` already collected in subtrees)
+
+    >>> collect_params(Compiler.compile({'a': ['{x}', '{y}'], 'b': '{x}{z}'}))
+    ('x', 'y', 'z')
+    """
+    params = {}
+    seen = set()  # subtrees shared by several parents are walked once
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node._params is not None:
+            params.update(dict.fromkeys(node._params))
+        elif node.has_params and id(node) not in seen:
+            seen.add(id(node))
+            stack.extend(reversed(node.children()))
+    return tuple(params)
+
+
+class Const(Node):
+    """A node that always renders to the same value"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+        self.params = ()
+
+    def render(self, kwargs: Kwargs):
+        return self.value
+
+    def _repr_arg(self):
+        return self.value
+
+
+class ConstCopy(Node):
+    """A node rendering a fresh copy of the same value, made with ``copier``"""
+
+    __slots__ = ('value', 'copier')
+
+    def __init__(self, value, copier: Callable):
+        self.value = value
+        self.copier = copier
+        self.params = ()
+
+    def render(self, kwargs: Kwargs):
+        return self.copier(self.value)
+
+    def _repr_arg(self):
+        return self.value
+
+
+class FormatStr(Node):
+    """A string with format fields, rendered by ``format_string_func``"""
+
+    __slots__ = ('template', 'render')
+
+    def __init__(self, template: str):
+        self.template = template
+        self.render = format_string_func(template)
+        self.params = self.render.params
+
+    def _repr_arg(self):
+        return self.template
+
+
+class Param(Node):
+    """A node rendering the value of a parameter itself, as is (see
+    ``whole_value_params``)"""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.params = (name,)
+
+    def render(self, kwargs: Kwargs):
+        return kwargs[self.name]
+
+    def _repr_arg(self):
+        return self.name
+
+
+class DictNode(Node):
+    """A dict whose keys and values are nodes"""
+
+    __slots__ = ('items', '_const_keys', '_key_renders', '_value_renders')
+
+    def __init__(self, items: Iterable[Tuple[Node, Node]]):
+        self.items = tuple(items)
+        self._set_children_params(chain.from_iterable(self.items))
+        # keep the bound render methods around so rendering doesn't look them up
+        self._value_renders = tuple(v.render for _, v in self.items)
+        if all(type(k) is Const for k, _ in self.items):
+            # the usual case: static keys, so only values need to be rendered
+            self._const_keys = tuple(k.value for k, _ in self.items)
+            self._key_renders = None
+        else:
+            self._const_keys = None
+            self._key_renders = tuple(k.render for k, _ in self.items)
+
+    def render(self, kwargs: Kwargs):
+        values = [value(kwargs) for value in self._value_renders]
+        if self._const_keys is not None:
+            return dict(zip(self._const_keys, values))
+        return dict(zip([key(kwargs) for key in self._key_renders], values))
+
+    def children(self) -> Tuple[Node, ...]:
+        return tuple(chain.from_iterable(self.items))
+
+    def with_children(self, children: Iterable[Node]) -> Node:
+        children = iter(children)
+        return type(self)(zip(children, children))
+
+    def assemble(self, values: list):
+        values = iter(values)
+        return dict(zip(values, values))
+
+    def _repr_arg(self):
+        return self.items
+
+
+class ListNode(Node):
+    """A list whose items are nodes"""
+
+    __slots__ = ('items', '_renders')
+
+    def __init__(self, items: Iterable[Node]):
+        self.items = tuple(items)
+        self._set_children_params(self.items)
+        self._renders = tuple(item.render for item in self.items)
+
+    def render(self, kwargs: Kwargs):
+        return [item(kwargs) for item in self._renders]
+
+    def children(self) -> Tuple[Node, ...]:
+        return self.items
+
+    def with_children(self, children: Iterable[Node]) -> Node:
+        return type(self)(children)
+
+    def assemble(self, values: list):
+        return values
+
+    def _repr_arg(self):
+        return self.items
+
+
+class ConstructNode(Node):
+    """Renders its items, and makes an object from the list of their values with
+    ``make`` (e.g. ``tuple``, or the positional constructor of a namedtuple)"""
+
+    __slots__ = ('items', 'make', '_renders')
+
+    def __init__(self, items: Iterable[Node], make: Callable[[list], Any]):
+        self.items = tuple(items)
+        self.make = make
+        self._set_children_params(self.items)
+        self._renders = tuple(item.render for item in self.items)
+
+    def render(self, kwargs: Kwargs):
+        return self.make([item(kwargs) for item in self._renders])
+
+    def children(self) -> Tuple[Node, ...]:
+        return self.items
+
+    def with_children(self, children: Iterable[Node]) -> Node:
+        return type(self)(children, self.make)
+
+    def assemble(self, values: list):
+        return self.make(values)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.items!r}, {self.make!r})'
+
+
+class LoopNode(Node):
+    """A list with a render of ``node`` per value of the parameter ``param``, each
+    rendered with the value as the parameter ``item`` (see ``ForEach``)"""
+
+    __slots__ = ('param', 'node', 'item', '_render_item')
+
+    def __init__(self, param: str, node: Node, item: str = 'item'):
+        self.param = param
+        self.node = node
+        self.item = item
+        outer_params = (p for p in node.params if p != item)
+        self.params = tuple(dict.fromkeys(chain([param], outer_params)))
+        self._render_item = node.render
+
+    def render(self, kwargs: Kwargs):
+        render_item, scope = self._render_item, dict(kwargs)
+        # the comprehension binds each value in scope itself: no dict per item
+        return [render_item(scope) for scope[self.item] in kwargs[self.param]]
+
+    def iter_items(self, kwargs: Kwargs) -> Iterator:
+        """Lazily render the items, one at a time"""
+        render_item, scope = self._render_item, dict(kwargs)
+        for scope[self.item] in kwargs[self.param]:
+            yield render_item(scope)
+
+    def children(self) -> Tuple[Node, ...]:
+        return (self.node,)
+
+    def with_children(self, children: Iterable[Node]) -> Node:
+        (node,) = children
+        return type(self)(self.param, node, self.item)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.param!r}, {self.node!r}, {self.item!r})'
+
+
+class Dataclass(ABC):
+    """Virtual base class of dataclasses, to register handlers of dataclass templates
+
+    >>> from dataclasses import dataclass
+    >>> @dataclass
+    ... class Point:
+    ...     x: int
+    >>> isinstance(Point(1), Dataclass), isinstance((1,), Dataclass)
+    (True, False)
+    """
+
+    @classmethod
+    def __subclasshook__(cls, C):
+        return True if is_dataclass(C) else NotImplemented
+
+
+def _dataclass_constructor(cls):
+    init_fields = [f for f in fields(cls) if f.init]
+    kw_only = tuple(f.name for f in init_fields if getattr(f, 'kw_only', False))
+    n_positional = len(init_fields) - len(kw_only)
+    if not kw_only:
+        return lambda values: cls(*values)
+    return lambda values: cls(
+        *values[:n_positional], **dict(zip(kw_only, values[n_positional:]))
+    )
+
+
+def positional_constructor(cls: type) -> Callable[[list], Any]:
+    """A function making an instance of ``cls`` from the list of its items (or init
+    fields, for dataclasses), computed once per class.
+
+    >>> from collections import namedtuple
+    >>> Point = namedtuple('Point', 'x y')
+    >>> positional_constructor(Point)([1, 2])
+    Point(x=1, y=2)
+    >>> positional_constructor(frozenset)([1, 2])
+    frozenset({1, 2})
+    """
+    if issubclass(cls, tuple) and hasattr(cls, '_fields'):  # a namedtuple
+        return partial(tuple.__new__, cls)
+    elif is_dataclass(cls):
+        return _dataclass_constructor(cls)
+    return cls
+
+
+def container_constructor(template) -> Callable[[Union[dict, list]], Any]:
+    """A function making, from a plain dict or list, a container of the type of
+    ``template`` (a dict or list subclass), with its other attributes (e.g. the
+    ``default_factory`` of a ``defaultdict``)
+
+    >>> from collections import defaultdict
+    >>> container_constructor(defaultdict(list, a=1))({'b': 2})
+    defaultdict(<class 'list'>, {'b': 2})
+    """
+    empty = shallow_copy(template)
+    empty.clear()
+    fill = (
+        type(template).update if isinstance(template, dict) else type(template).extend
+    )
+
+    def construct(items: Union[dict, list]):
+        obj = shallow_copy(empty)
+        fill(obj, items)
+        return obj
+
+    return construct
+
+
+def template_items(template) -> list:
+    """The items of a container template, in the order ``positional_constructor``
+    expects them"""
+    if is_dataclass(template):
+        return [getattr(template, f.name) for f in fields(template) if f.init]
+    return list(template)
+
+
+def cached_mro_lookup(
+    registry: Mapping[type, Callable],
+    cache: Dict[Tuple[type, type], Optional[Callable]],
+    owner: type,
+    obj_type: type,
+) -> Optional[Callable]:
+    """The handler ``registry`` has for the first type of the MRO of ``obj_type``
+    (like ``functools.singledispatch`` does), or ``None`` if there's none.
+    If no type of the MRO is registered, abstract base classes of the registry
+    (e.g. ``Dataclass``) that ``obj_type`` is a virtual subclass of are tried.
+
+    Resolutions are cached in ``cache`` under ``(owner, obj_type)``, so
+    classes sharing a cache can have different registries, and a type is only looked
+    up along its MRO once (the cache should be cleared when ``registry`` changes).
+
+    >>> from collections import OrderedDict
+    >>> registry, cache = {dict: 'dict handler'}, {}
+    >>> cached_mro_lookup(registry, cache, None, OrderedDict)
+    'dict handler'
+    >>> cache
+    {(None, <class 'collections.OrderedDict'>): 'dict handler'}
+    >>> cached_mro_lookup(registry, cache, None, list) is None
+    True
+    """
+    key = (owner, obj_type)
+    try:
+        return cache[key]
+    except KeyError:
+        handler = next((registry[t] for t in obj_type.__mro__ if t in registry), None)
+        if handler is None:
+            handler = next(
+                (
+                    h
+                    for t, h in registry.items()
+                    if isinstance(t, ABCMeta) and issubclass(obj_type, t)
+                ),
+                None,
+            )
+        cache[key] = handler
+        return handler
+
+
+class Compiler:
+    """Compiles templates into render plan nodes, dispatching on the template type.
+
+    Mirrors ``Templater``: handlers are registered per type with ``register``, are
+    used for subclasses of that type too (the closest along the MRO wins), and
+    templates of unregistered types compile to ``Const`` nodes.
+
+    >>> from collections import OrderedDict
+    >>> rendered = Compiler.compile(OrderedDict(a='{x}')).render({'x': 1})
+    >>> type(rendered).__name__, dict(rendered)
+    ('OrderedDict', {'a': '1'})
+    """
+
+    compiler_registry: Dict[type, Callable[[Any], Node]] = {}
+    # handlers resolved along the MRO, per (compiler class, template type)
+    _handler_cache: Dict[Tuple[type, type], Optional[Callable]] = {}
+    # the templates of named fragments (see ``Include``), and their (folded) plans
+    # per (compiler class, name)
+    fragment_registry: Dict[str, Any] = {}
+    _fragment_nodes: Dict[Tuple[type, str], Node] = {}
+    _fragments_compiling: set = set()
+
+    @classmethod
+    def register(cls, handles_type: type):
+        def decorator(f):
+            cls.compiler_registry[handles_type] = f
+            cls._handler_cache.clear()
+            return f
+
+        return decorator
+
+    @classmethod
+    def register_fragment(cls, name: str, template):
+        """Register ``template`` as the fragment that ``Include(name)`` stands for.
+
+        Templates compiled before a fragment is registered again keep the plan of
+        the previous one.
+        """
+        cls.fragment_registry[name] = template
+        for key in [key for key in cls._fragment_nodes if key[1] == name]:
+            del cls._fragment_nodes[key]
+
+    @classmethod
+    def fragment_node(cls, name: str) -> Node:
+        """The root of the plan of the fragment registered as ``name``, compiled (by
+        ``cls``) and folded (see ``fold_constants``) the first time it's asked for,
+        and shared by all the plans (of ``cls``) including it"""
+        key = (cls, name)
+        node = cls._fragment_nodes.get(key)
+        if node is not None:
+            return node
+        if name not in cls.fragment_registry:
+            raise KeyError(f'No fragment registered as {name!r}')
+        if key in cls._fragments_compiling:
+            raise ValueError(f'Fragment {name!r} includes itself')
+        cls._fragments_compiling.add(key)
+        try:
+            node = fold_constants(cls.compile(cls.fragment_registry[name]))
+        finally:
+            cls._fragments_compiling.discard(key)
+        node.params  # collected once, for all the plans including it
+        cls._fragment_nodes[key] = node
+        return node
+
+    @classmethod
+    def handler(cls, template) -> Optional[Callable[[Any], Node]]:
+        return cached_mro_lookup(
+            cls.compiler_registry, cls._handler_cache, cls, type(template)
+        )
+
+    @classmethod
+    def compile(cls, template) -> Node:
+        """Compile ``template`` into the root node of its render plan.
+
+        Nested containers whose handlers are made with ``container_handler`` are
+        walked with an explicit stack, so templates can be nested deeper than the
+        recursion limit.
+        """
+        handler = cls.handler(template)
+        if not hasattr(handler, 'make_node'):
+            return cls._leaf_node(handler, template)
+        # (container, handler, iterator of its items, nodes of the items compiled)
+        stack = [(template, handler, iter(handler.container_items(template)), [])]
+        while True:
+            template, handler, items, nodes = stack[-1]
+            for item in items:
+                item_handler = cls.handler(item)
+                if hasattr(item_handler, 'make_node'):
+                    item_items = iter(item_handler.container_items(item))
+                    stack.append((item, item_handler, item_items, []))
+                    break
+                else:
+                    nodes.append(cls._leaf_node(item_handler, item))
+            else:
+                stack.pop()
+                node = handler.make_node(template, nodes)
+                if not stack:
+                    return node
+                stack[-1][3].append(node)
+
+    @classmethod
+    def _leaf_node(cls, handler: Optional[Callable], template) -> Node:
+        if handler is None:
+            return Const(template)
+        with_compiler = getattr(handler, 'with_compiler', None)
+        if with_compiler is not None:
+            return with_compiler(cls, template)
+        return handler(template)
+
+
+def container_handler(container_items: Callable[[Any], Iterable]):
+    """Make a ``Compiler`` handler of containers from a function making the node of
+    a container from the compiled nodes of its items (``container_items(template)``).
+
+    Called, the handler compiles the items of a template (recursively) and makes its
+    node, but ``Compiler.compile`` uses its ``container_items`` and ``make_node``
+    attributes to walk nested containers without recursion.
+    """
+
+    def decorator(make_node: Callable[[Any, List[Node]], Node]):
+        @wraps(make_node)
+        def handler(template, compiler=None) -> Node:
+            compile_item = (compiler or Compiler).compile
+            items = container_items(template)
+            return make_node(template, [compile_item(item) for item in items])
+
+        handler.container_items = container_items
+        handler.make_node = make_node
+        return handler
+
+    return decorator
+
+
+def compiler_handler(make_node: Callable[[type, Any], Node]):
+    """Make a ``Compiler`` handler from a function making the node of a template
+    given the compiler (class) compiling it, for handlers compiling templates of
+    their own (e.g. the fragments of ``Include``), which should use the same
+    compiler.
+    """
+
+    @wraps(make_node)
+    def handler(template, compiler=None) -> Node:
+        return make_node(compiler or Compiler, template)
+
+    handler.with_compiler = make_node
+    return handler
+
+
+@Compiler.register(str)
+def compile_str(template: str) -> Node:
+    """Compile a string template.
+
+    >>> compile_str('{a} and {b} and {a}')
+    FormatStr('{a} and {b} and {a}')
+    >>> _.params
+    ('a', 'b')
+
+    Strings without fields are formatted once, at compile time:
+
+    >>> compile_str('no {{fields}} here')
+    Const('no {fields} here')
+
+    Parameters are the names fields start with:
+
+    >>> compile_str('{user.name} is {ages[0]:>{width}}').params
+    ('user', 'ages', 'width')
+    """
+    node = FormatStr(template)
+    if not node.has_params:
+        return Const(template.format())
+    return node
+
+
+def _dict_items(template: dict) -> Iterable:
+    return chain.from_iterable(template.items())
+
+
+@Compiler.register(dict)
+@container_handler(_dict_items)
+def compile_dict(template: dict, nodes: List[Node]) -> Node:
+    """Compile a dict template. Templates of dict subclasses render to their type
+    (see ``container_constructor``).
+
+    >>> from collections import defaultdict
+    >>> compile_dict(defaultdict(list, a='{x}')).render({'x': 1})
+    defaultdict(<class 'list'>, {'a': '1'})
+    """
+    nodes = iter(nodes)
+    node = DictNode(zip(nodes, nodes))
+    return node if type(template) is dict else _retyped(node, template)
+
+
+@Compiler.register(list)
+@container_handler(iter)
+def compile_list(template: list, nodes: List[Node]) -> Node:
+    node = ListNode(nodes)
+    return node if type(template) is list else _retyped(node, template)
+
+
+def _retyped(node: Node, template) -> Node:
+    """``node``, rendering a plain dict or list, made to render the type of
+    ``template``"""
+    construct = container_constructor(template)
+    return ConstructNode([node], lambda values: construct(values[0]))
+
+
+@Compiler.register(tuple)
+@Compiler.register(set)
+@Compiler.register(frozenset)
+@Compiler.register(Dataclass)
+@container_handler(template_items)
+def compile_constructed(template, nodes: List[Node]) -> Node:
+    """Compile a tuple (or namedtuple), set, frozenset or dataclass template, which
+    renders to an object of the same type.
+
+    >>> from collections import namedtuple
+    >>> from dataclasses import dataclass
+    >>> Point = namedtuple('Point', 'x y')
+    >>> compile_constructed(Point('{x}', 0)).render({'x': 1})
+    Point(x='1', y=0)
+    >>> @dataclass
+    ... class Person:
+    ...     name: str
+    ...     tags: tuple = ()
+    >>> compile_constructed(Person('{name}', ('{tag}', 'b'))).render(
+    ...     {'name': 'Ann', 'tag': 'a'}
+    ... )
+    Person(name='Ann', tags=('a', 'b'))
+    """
+    return ConstructNode(nodes, positional_constructor(type(template)))
+
+
+class Include:
+    """Stands, in a template, for the fragment registered as ``name`` (with
+    ``Compiler.register_fragment``).
+
+    A fragment is compiled and folded (see ``fold_constants``, copying its folded
+    values, whatever the ``fold`` option of the templates including it) once, the
+    first time it's included, and its plan is shared by all the plans including it
+    (which are then DAGs rather than trees): compiling a template costs nothing
+    more per inclusion, and the plans of all the templates including a fragment
+    hold one copy of it. Its parameters are parameters of the templates including
+    it.
+
+    >>> Compiler.register_fragment(
+    ...     'address', {'city': '{city}', 'zip': '{zip}', 'tags': ['home']}
+    ... )
+    >>> shipping = CompiledTemplate({'to': '{name}', 'address': Include('address')})
+    >>> billing = CompiledTemplate({'billing': [Include('address')]})
+    >>> shipping.params
+    ('name', 'city', 'zip')
+    >>> shipping(name='Ann', city='Paris', zip='75001')
+    {'to': 'Ann', 'address': {'city': 'Paris', 'zip': '75001', 'tags': ['home']}}
+    >>> shipping.root.items[1][1] is billing.root.items[0][1].items[0]
+    True
+
+    Fragments can include other fragments (but not themselves).
+
+    Pickled, an ``Include`` carries its fragment, which is registered when it's
+    unpickled in a process that doesn't have it (e.g. the workers of
+    ``CompiledTemplate.render_parallel``).
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.name == self.name
+
+    def __hash__(self):
+        return hash((type(self), self.name))
+
+    def __reduce__(self):
+        if self.name not in Compiler.fragment_registry:
+            return type(self), (self.name,)
+        return _unpickle_include, (self.name, Compiler.fragment_registry[self.name])
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.name!r})'
+
+
+def _unpickle_include(name: str, fragment) -> Include:
+    if name not in Compiler.fragment_registry:
+        Compiler.register_fragment(name, fragment)
+    return Include(name)
+
+
+@Compiler.register(Include)
+@compiler_handler
+def compile_include(compiler, template: Include) -> Node:
+    return compiler.fragment_node(template.name)
+
+
+class ForEach:
+    """Stands, in a template, for a list with a render of ``template`` per value of
+    the parameter ``param``, where the value is the parameter ``item`` (the other
+    parameters of ``template`` being those of the template containing it).
+
+    The list is rendered in a single loop (by a ``LoopNode``), and the items can
+    also be rendered lazily (see ``iter_render`` and ``iter_json``).
+
+    >>> g = CompiledTemplate(
+    ...     {'order': '{id}', 'lines': ForEach('rows', {'sku': '{item[sku]}', 'order': '{id}'})}
+    ... )
+    >>> g.params
+    ('id', 'rows')
+    >>> g(id=7, rows=[{'sku': 'a'}, {'sku': 'b'}])
+    {'order': '7', 'lines': [{'sku': 'a', 'order': '7'}, {'sku': 'b', 'order': '7'}]}
+    >>> g.root.items[1][1]  # doctest: +NORMALIZE_WHITESPACE
+    LoopNode('rows', DictNode(((Const('sku'), FormatStr('{item[sku]}')),
+                               (Const('order'), FormatStr('{id}')))), 'item')
+
+    The streaming variant renders one item at a time:
+
+    >>> g = CompiledTemplate(ForEach('rows', '{item[sku]}'))
+    >>> items = g.iter_render({'rows': [{'sku': 'a'}, {'sku': 'b'}]})
+    >>> next(items)
+    'a'
+    >>> ''.join(g.iter_json({'rows': [{'sku': 'a'}, {'sku': 'b'}]}))
+    '["a", "b"]'
+    """
+
+    __slots__ = ('param', 'template', 'item')
+
+    def __init__(self, param: str, template, item: str = 'item'):
+        self.param = param
+        self.template = template
+        self.item = item
+
+    def __repr__(self):
+        args = f'{self.param!r}, {self.template!r}, {self.item!r}'
+        return f'{type(self).__name__}({args})'
+
+
+@Compiler.register(ForEach)
+@container_handler(lambda template: [template.template])
+def compile_for_each(template: ForEach, nodes: List[Node]) -> Node:
+    (node,) = nodes
+    return LoopNode(template.param, node, template.item)
+
+
+def copier_for(value) -> Optional[Callable]:
+    """A function copying the mutable containers (dicts, lists, sets, dataclasses) of
+    ``value``, specialized to its structure, or ``None`` if ``value`` has none.
+
+    Like a render, the copy has new containers but shares the other objects.
+
+    >>> value = {'a': 1, 'b': [2, {'c': 3}], 'd': (4,), 'e': ('f', [5])}
+    >>> copy = copier_for(value)(value)
+    >>> copy == value, copy is value, copy['b'][1] is value['b'][1]
+    (True, False, False)
+    >>> copy['d'] is value['d'], copy['e'][1] is value['e'][1]
+    (True, False)
+    >>> copier_for('immutable') is None
+    True
+
+    Values nested deeper than ``MAX_RECURSIVE_HEIGHT`` are copied by a (slower)
+    function walking them with an explicit stack (see ``copy_containers``).
+    """
+    try:
+        return _copier_for(value, MAX_RECURSIVE_HEIGHT)
+    except _TooDeep:
+        return copy_containers
+
+
+class _TooDeep(Exception):
+    """Raised by ``_copier_for`` for values nested deeper than it's allowed to go"""
+
+
+def _copier_for(value, max_height: int) -> Optional[Callable]:
+    if max_height == 0:
+        raise _TooDeep
+    value_type = type(value)
+    if isinstance(value, dict):
+        copiers = (_copier_for(v, max_height - 1) for v in value.values())
+        nested = tuple((k, c) for k, c in zip(value, copiers) if c)
+    elif isinstance(value, list):
+        copiers = (_copier_for(item, max_height - 1) for item in value)
+        nested = tuple((i, c) for i, c in enumerate(copiers) if c)
+    elif value_type is set:
+        return set.copy  # set elements are hashable, so (usually) immutable
+    elif isinstance(value, tuple):
+        return _tuple_copier(value, max_height)
+    elif is_dataclass(value):
+        return _dataclass_copier(value, max_height)
+    else:
+        return None
+    # a shallow copy (in C, for dicts and lists, while subclasses may not copy
+    # themselves to their type)
+    copy = value_type.copy if value_type in (dict, list) else shallow_copy
+    if not nested:
+        return copy
+
+    def copy_nested(obj):
+        obj = copy(obj)
+        for k, copy_item in nested:
+            obj[k] = copy_item(obj[k])
+        return obj
+
+    return copy_nested
+
+
+def _tuple_copier(value: tuple, max_height: int) -> Optional[Callable]:
+    copiers = (_copier_for(item, max_height - 1) for item in value)
+    nested = tuple((i, c) for i, c in enumerate(copiers) if c)
+    if not nested:
+        return None  # immutable all the way down
+    make = positional_constructor(type(value))
+
+    def copy_tuple(obj):
+        items = list(obj)
+        for i, copy_item in nested:
+            items[i] = copy_item(items[i])
+        return make(items)
+
+    return copy_tuple
+
+
+def _dataclass_copier(value, max_height: int) -> Callable:
+    names = [f.name for f in fields(value)]
+    copiers = (_copier_for(getattr(value, n), max_height - 1) for n in names)
+    nested = tuple((name, c) for name, c in zip(names, copiers) if c)
+
+    def copy_dataclass(obj):
+        obj = shallow_copy(obj)
+        for name, copy_item in nested:
+            # object.__setattr__, since the dataclass may be frozen
+            object.__setattr__(obj, name, copy_item(getattr(obj, name)))
+        return obj
+
+    return copy_dataclass
+
+
+def copy_containers(value):
+    """Copy the mutable containers of ``value`` like the functions made by
+    ``copier_for`` do, but walking it with an explicit stack, so it can be nested
+    deeper than the recursion limit
+
+    >>> value = ('a', [{'b': 1}])
+    >>> copy = copy_containers(value)
+    >>> copy == value, copy[1][0] is value[1][0]
+    (True, False)
+    """
+    # (container, the items to copy, their copies so far)
+    stack = [(None, [value], [])]
+    while True:
+        obj, items, copies = stack[-1]
+        while len(copies) < len(items):
+            item = items[len(copies)]
+            item_type = type(item)
+            if isinstance(item, dict):
+                stack.append((item, list(item.values()), []))
+                break
+            elif isinstance(item, (list, tuple)):
+                stack.append((item, item, []))
+                break
+            elif is_dataclass(item) and not isinstance(item, type):
+                names = [f.name for f in fields(item)]
+                stack.append((item, [getattr(item, n) for n in names], []))
+                break
+            copies.append(set.copy(item) if item_type is set else item)
+        else:
+            stack.pop()
+            if obj is None:
+                return copies[0]
+            obj_type = type(obj)
+            if obj_type is dict:
+                copy = dict(zip(obj, copies))
+            elif obj_type is list:
+                copy = copies
+            elif isinstance(obj, dict):
+                copy = shallow_copy(obj)
+                copy.update(zip(obj, copies))
+            elif isinstance(obj, list):
+                copy = shallow_copy(obj)
+                copy[:] = copies
+            elif isinstance(obj, tuple):
+                if all(map(operator.is_, copies, obj)):
+                    copy = obj  # immutable all the way down
+                else:
+                    copy = positional_constructor(obj_type)(copies)
+            else:
+                copy = shallow_copy(obj)
+                for f, item in zip(fields(obj), copies):
+                    object.__setattr__(copy, f.name, item)
+            stack[-1][2].append(copy)
+
+
+# subtrees taller than this are rendered (and folded) with an explicit stack rather
+# than recursive calls, to stay clear of the recursion limit
+MAX_RECURSIVE_HEIGHT = 100
+
+
+def plan_heights(root: Node) -> Dict[int, int]:
+    """The height of every node of the plan of ``root`` (1 for nodes without
+    children), by ``id``
+
+    >>> root = Compiler.compile({'a': ['{x}']})
+    >>> plan_heights(root)[id(root)]
+    3
+    """
+    heights = {}
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        children = node.children()
+        if children_done:
+            heights[id(node)] = 1 + max(heights[id(child)] for child in children)
+        elif id(node) in heights:
+            continue  # a subtree shared by several parents, already measured
+        elif children:
+            stack.append((node, True))
+            stack.extend((child, False) for child in children)
+        else:
+            heights[id(node)] = 1
+    return heights
+
+
+def transform_plan(root: Node, transform: Callable[[Node], Optional[Node]]) -> Node:
+    """Rebuild the plan of ``root``, without recursion: nodes for which
+    ``transform`` returns a node are replaced by it, and the others (for which it
+    returns ``None``) are rebuilt with their transformed children.
+
+    >>> root = Compiler.compile({'a': ['{x}', 1]})
+    >>> transform_plan(root, lambda node: Const(2) if type(node) is Const else None)
+    DictNode(((Const(2), ListNode((FormatStr('{x}'), Const(2)))),))
+    """
+    transformed = transform(root)
+    if transformed is not None:
+        return transformed
+    # the new nodes of the nodes done, by id: subtrees shared by several parents
+    # (see ``Include``) are transformed once, and stay shared
+    done: Dict[int, Node] = {}
+    # (node, its children, its transformed children so far)
+    stack = [(root, root.children(), [])]
+    while True:
+        node, children, new_children = stack[-1]
+        while len(new_children) < len(children):
+            child = children[len(new_children)]
+            if id(child) in done:
+                new_children.append(done[id(child)])
+                continue
+            transformed = transform(child)
+            if transformed is not None:
+                new_children.append(transformed)
+                done[id(child)] = transformed
+            elif child.children():
+                stack.append((child, child.children(), []))
+                break
+            else:
+                new_children.append(child)
+        else:
+            stack.pop()
+            if all(map(operator.is_, new_children, children)):
+                rebuilt = node  # unchanged
+            else:
+                rebuilt = node.with_children(new_children)
+            done[id(node)] = rebuilt
+            if not stack:
+                return rebuilt
+            stack[-1][2].append(rebuilt)
+
+
+def fold_constants(node: Node, copy: bool = True) -> Node:
+    """Replace the subtrees of ``node`` that don't depend on any parameter by nodes
+    rendering the value they evaluate to, computed once.
+
+    :param node: The root of the plan to fold
+    :param copy: Whether folded values should be copied on every render (with a
+        cheap copier specialized to their structure) or shared by all renders
+
+    Subtrees taller than ``MAX_RECURSIVE_HEIGHT`` aren't folded as a whole (their
+    values couldn't be copied recursively), but their lower parts are.
+
+    >>> plan = Compiler.compile({'static': {'a': [1, 2]}, 'dynamic': ['{x}', 'y']})
+    >>> fold_constants(plan, copy=False)  # doctest: +NORMALIZE_WHITESPACE
+    DictNode(((Const('static'), Const({'a': [1, 2]})),
+              (Const('dynamic'), ListNode((FormatStr('{x}'), Const('y'))))))
+    >>> fold_constants(plan).render({'x': 0})
+    {'static': {'a': [1, 2]}, 'dynamic': ['0', 'y']}
+    """
+    heights = plan_heights(node)
+
+    def fold(node: Node) -> Optional[Node]:
+        if node.has_params or heights[id(node)] > MAX_RECURSIVE_HEIGHT:
+            return None
+        elif isinstance(node, (Const, ConstCopy)):
+            return node
+        value = node.render({})
+        copier = copy and copier_for(value)
+        return ConstCopy(value, copier) if copier else Const(value)
+
+    return transform_plan(node, fold)
+
+
+def _whole_value_param(template: str) -> Optional[str]:
+    """The parameter of ``template`` if it's a single, bare field (like ``'{x}'``)"""
+    if template[:1] == '{' and template[-1:] == '}':
+        name = template[1:-1]
+        if name.isidentifier():
+            return name
+    return None
+
+
+def whole_value_params(node: Node) -> Node:
+    """Replace the strings of the plan of ``node`` that are a single, bare field (like
+    ``'{x}'``) by ``Param`` nodes, which render the parameter value itself instead of
+    formatting it into a string. Dict keys are left as they are.
+
+    >>> plan = Compiler.compile({'x': '{x}', 'xs': ['{x}!', '{x!r}', '{x}']})
+    >>> whole_value_params(plan)  # doctest: +NORMALIZE_WHITESPACE
+    DictNode(((Const('x'), Param('x')),
+              (Const('xs'), ListNode((FormatStr('{x}!'), FormatStr('{x!r}'),
+                                      Param('x'))))))
+    >>> whole_value_params(plan).render({'x': [1.5, None]})
+    {'x': [1.5, None], 'xs': ['[1.5, None]!', '[1.5, None]', [1.5, None]]}
+    """
+    key_ids = set()  # of the key nodes of dicts, met before their keys
+
+    def substitute(node: Node) -> Optional[Node]:
+        if id(node) in key_ids:
+            return node
+        elif type(node) is FormatStr:
+            name = _whole_value_param(node.template)
+            return node if name is None else Param(name)
+        elif type(node) is DictNode:
+            key_ids.update(id(k) for k, _ in node.items)
+        return None
+
+    return transform_plan(node, substitute)
+
+
+class Bound(Node):
+    """A node rendering the node it wraps with the values of the ``bound``
+    parameters (for the nodes ``bind_params`` can't substitute them in)"""
+
+    __slots__ = ('node', 'bound')
+
+    def __init__(self, node: Node, bound: Kwargs):
+        self.node = node
+        self.bound = {name: bound[name] for name in node.params if name in bound}
+        self.params = tuple(name for name in node.params if name not in bound)
+
+    def render(self, kwargs: Kwargs):
+        return self.node.render({**self.bound, **kwargs})
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.node!r}, {self.bound!r})'
+
+
+def _bind_format_str(node: FormatStr, bound: Kwargs) -> Optional[Node]:
+    """Substitute the fields of ``node`` whose parameters are in ``bound`` (or
+    ``None`` if a field's value is bound but not the fields nested in its spec)"""
+    parts = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(
+        node.template
+    ):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field_name is None:
+            continue
+        field = '{' + field_name
+        field += f'!{conversion}' if conversion else ''
+        field += f':{format_spec}' if format_spec else ''
+        field += '}'
+        if bound.keys().isdisjoint(format_string_params(field)):
+            parts.append(field)
+            continue
+        if '{' in format_spec:
+            if not all(p in bound for p in format_string_params(format_spec)):
+                return None
+            format_spec = format_spec.format_map(bound)
+            field = field[: field.index(':') + 1] + format_spec + '}'
+        if bound.keys().isdisjoint(format_string_params(field)):
+            parts.append(field)
+        elif '{' in format_spec or '}' in format_spec:
+            return None  # (a bound spec with braces can't be formatted back in)
+        else:
+            value = field.format_map(bound)
+            parts.append(value.replace('{', '{{').replace('}', '}}'))
+    return compile_str(''.join(parts))
+
+
+def _bind_loop(node: LoopNode, bound: Kwargs) -> Node:
+    """Bind the parameters of the items of a loop: its ``item`` isn't bound, and
+    the loop is unrolled if its values are"""
+    bound = {name: value for name, value in bound.items() if name != node.item}
+    if node.param in bound:
+        return ListNode(
+            bind_params(node.node, {**bound, node.item: value})
+            for value in bound[node.param]
+        )
+    return node.with_children([bind_params(node.node, bound)])
+
+
+def bind_params(node: Node, bound: Kwargs) -> Node:
+    """Substitute the values of the ``bound`` parameters in the plan of ``node``:
+    parts that only depend on bound parameters become constants, and the fields of
+    bound parameters are formatted into the strings that also have other fields.
+    Other nodes using bound and unbound parameters render with the bound values
+    (see ``Bound``).
+
+    >>> plan = Compiler.compile({'url': '{host}/{path}', 'env': '{env}', 'n': '{n}'})
+    >>> bind_params(plan, {'host': 'h.com', 'env': 'prod'})  # doctest: +NORMALIZE_WHITESPACE
+    DictNode(((Const('url'), FormatStr('h.com/{path}')),
+              (Const('env'), Const('prod')),
+              (Const('n'), FormatStr('{n}'))))
+    >>> bind_params(Compiler.compile('{w:>{n}}'), {'n': 4})
+    FormatStr('{w:>4}')
+    >>> bind_params(Compiler.compile('{w:>{n}}'), {'w': 'ab'})
+    Bound(FormatStr('{w:>{n}}'), {'w': 'ab'})
+    """
+
+    def bind(node: Node) -> Optional[Node]:
+        if not node.has_params:
+            return node
+        elif type(node) is LoopNode:
+            return _bind_loop(node, bound)
+        elif node.children():
+            return None
+        elif bound.keys().isdisjoint(node.params):
+            return node
+        elif all(param in bound for param in node.params):
+            return Const(node.render(bound))
+        elif type(node) is FormatStr:
+            return _bind_format_str(node, bound) or Bound(node, bound)
+        return Bound(node, bound)
+
+    return transform_plan(node, bind)
+
+
+def iterative_render(root: Node, max_height: int = MAX_RECURSIVE_HEIGHT):
+    """A function rendering the plan of ``root`` from a kwargs mapping, walking the
+    containers taller than ``max_height`` with an explicit stack (lower subtrees are
+    rendered by the faster recursive calls of their ``render``), so plans can be
+    nested deeper than the recursion limit.
+
+    >>> template = '{x}'
+    >>> for _ in range(5000):
+    ...     template = [template]
+    >>> render = iterative_render(Compiler.compile(template))
+    >>> value = render({'x': 1})
+    >>> for _ in range(5000):
+    ...     value = value[0]
+    >>> value
+    '1'
+    """
+    tall = {
+        id(node): node
+        for node in _tall_containers(root, plan_heights(root), max_height)
+    }
+    if id(root) not in tall:
+        return root.render
+    # the children of the containers to walk, and whether each is to be walked too
+    walked = {
+        node_id: (node.children(), tuple(id(c) in tall for c in node.children()))
+        for node_id, node in tall.items()
+    }
+
+    def render(kwargs: Kwargs):
+        # (node, its children, whether each is walked, renders of its children)
+        stack = [(root, *walked[id(root)], [])]
+        while True:
+            node, children, is_walked, values = stack[-1]
+            while len(values) < len(children):
+                i = len(values)
+                if is_walked[i]:
+                    stack.append((children[i], *walked[id(children[i])], []))
+                    break
+                values.append(children[i].render(kwargs))
+            else:
+                stack.pop()
+                value = node.assemble(values)
+                if not stack:
+                    return value
+                stack[-1][3].append(value)
+
+    return render
+
+
+def _tall_containers(root: Node, heights: Dict[int, int], max_height: int):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if heights[id(node)] > max_height and node.assemble is not None:
+            yield node
+            stack.extend(node.children())
+
+
+def index_entries_by_param(
+    entries_params: Iterable[Tuple[Any, Iterable[str]]]
+) -> Dict[str, Tuple]:
+    """Invert ``(entry, params of entry)`` pairs into a ``{param: entries}`` index.
+
+    >>> index_entries_by_param([('a', ['x']), ('b', ['x', 'y']), ('c', [])])
+    {'x': ('a', 'b'), 'y': ('b',)}
+    """
+    index = {}
+    for entry, params in entries_params:
+        for param in params:
+            index.setdefault(param, []).append(entry)
+    return {param: tuple(entries) for param, entries in index.items()}
+
+
+def _output_slots(node: Node) -> Optional[Tuple[Tuple[Any, Node], ...]]:
+    """The ``(key or index, child node)`` pairs of the containers ``node`` renders to,
+    if it's a dict (with static keys) or list node, else ``None``"""
+    if type(node) is DictNode and node._const_keys is not None:
+        return tuple(zip(node._const_keys, (v for _, v in node.items)))
+    elif type(node) is ListNode:
+        return tuple(enumerate(node.items))
+    return None
+
+
+def dependency_index(node: Node) -> Dict[str, List[tuple]]:
+    """Map each parameter to the paths (tuples of keys and indices) of the parts of
+    the render that depend on it.
+
+    >>> plan = Compiler.compile({'a': '{x}', 'b': ['{x}', '{y}', 'c'], 'd': 'e'})
+    >>> dependency_index(plan)
+    {'x': [('a',), ('b', 0)], 'y': [('b', 1)]}
+    """
+    index = {}
+    stack = [((), node)]
+    while stack:
+        path, node = stack.pop()
+        slots = _output_slots(node)
+        if slots is None:
+            for param in node.params:
+                index.setdefault(param, []).append(path)
+        else:
+            stack.extend(
+                (path + (key,), child)
+                for key, child in reversed(slots)
+                if child.has_params
+            )
+    return index
+
+
+class _Rerenderer:
+    """Re-renders the parts of a previous render that depend on changed parameters,
+    indexing (once, lazily) which children of each container depend on which
+    parameter"""
+
+    def __init__(self, root: Node):
+        self.root = root
+        self._slots_and_index = {}
+        self._renders = {}  # of the nodes rendered anew, by id
+
+    def _slots_and_index_of(self, node: Node):
+        key = id(node)
+        if key not in self._slots_and_index:
+            slots = _output_slots(node)
+            index = slots and index_entries_by_param(
+                (i, child.params) for i, (_, child) in enumerate(slots)
+            )
+            self._slots_and_index[key] = (slots, index)
+        return self._slots_and_index[key]
+
+    def rerender(self, node: Node, previous, kwargs: Kwargs, changed: set):
+        # the (container, key, child node) of the parts left to rerender
+        stack = []
+        new = self._rerender_node(node, previous, kwargs, changed, stack)
+        while stack:
+            container, key, child = stack.pop()
+            container[key] = self._rerender_node(
+                child, container[key], kwargs, changed, stack
+            )
+        return new
+
+    def _rerender_node(self, node, previous, kwargs, changed, stack: list):
+        """The rerender of ``node``, whose affected children are pushed on
+        ``stack``, to be rerendered into it"""
+        if changed.isdisjoint(node.params):
+            return previous
+        slots, index = self._slots_and_index_of(node)
+        container_type = dict if type(node) is DictNode else list
+        if (
+            slots is None
+            or type(previous) is not container_type
+            or len(previous) != len(slots)
+        ):
+            if id(node) not in self._renders:
+                self._renders[id(node)] = iterative_render(node)
+            return self._renders[id(node)](kwargs)
+        new = previous.copy()
+        affected = set(chain.from_iterable(index.get(p, ()) for p in changed))
+        for i in affected:
+            key, child = slots[i]
+            stack.append((new, key, child))
+        return new
+
+
+# the type and length of the container a node renders to, and the (key or index,
+# render, fill plan or None) of its templated children
+FillPlan = Tuple[type, int, Tuple[Tuple[Any, Callable, Optional['FillPlan']], ...]]
+
+
+def fill_plan(root: Node) -> Optional[FillPlan]:
+    """The templated slots of the containers ``root`` renders to, if it's a dict
+    (with static keys) or list node, else ``None`` (see ``render_into``)"""
+    heights = plan_heights(root)
+    plans = {}  # by node id: subtrees shared by several parents are planned once
+    stack = [(root, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in plans:
+            continue
+        slots = _output_slots(node)
+        if slots is None:
+            plans[id(node)] = None
+        elif children_done:
+            container_type = dict if type(node) is DictNode else list
+            templated_slots = tuple(
+                (key, _render_of(child, heights), plans[id(child)])
+                for key, child in slots
+                if child.has_params
+            )
+            plans[id(node)] = container_type, len(slots), templated_slots
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for _, child in slots if child.has_params)
+    return plans[id(root)]
+
+
+def _render_of(node: Node, heights: Dict[int, int]) -> Callable[[Kwargs], Any]:
+    """``node.render``, or, if ``node`` is too tall to render recursively, a
+    function making (once, the first time it's called) an ``iterative_render``"""
+    if heights[id(node)] <= MAX_RECURSIVE_HEIGHT:
+        return node.render
+    render = None
+
+    def render_tall(kwargs: Kwargs):
+        nonlocal render
+        if render is None:
+            render = iterative_render(node)
+        return render(kwargs)
+
+    return render_tall
+
+
+def fits(plan: FillPlan, target) -> bool:
+    """Whether ``target`` has the container type and length of ``plan``'s renders"""
+    return type(target) is plan[0] and len(target) == plan[1]
+
+
+def render_into(plan: FillPlan, target, kwargs: Kwargs):
+    """Overwrite the templated slots of ``target``, a previous render of the plan
+    of ``plan``, with their render for ``kwargs``, leaving static parts alone.
+
+    Nested containers of ``target`` are filled in place too, unless their type or
+    length doesn't match the template's, in which case they're replaced.
+
+    >>> root = Compiler.compile({'static': [1, 2], 'x': '{x}', 'ys': ['{y}', 0]})
+    >>> target = root.render({'x': 1, 'y': 2})
+    >>> ys = target['ys']
+    >>> render_into(fill_plan(root), target, {'x': 3, 'y': 4})
+    >>> target, target['ys'] is ys
+    ({'static': [1, 2], 'x': '3', 'ys': ['4', 0]}, True)
+    """
+    stack = [(plan, target)]
+    while stack:
+        plan, target = stack.pop()
+        for key, render, child_plan in plan[2]:
+            if child_plan is not None and fits(child_plan, target[key]):
+                stack.append((child_plan, target[key]))
+            else:
+                target[key] = render(kwargs)
+
+
+def path_str(path: tuple) -> str:
+    """The python indexing expression of a template path
+
+    >>> path_str(('how are you', 2))
+    "['how are you'][2]"
+    """
+    return ''.join(f'[{key!r}]' for key in path)
+
+
+class RenderProfile:
+    """Render call counts and cumulative times (including the time of sub-parts),
+    per template path (see ``profile_nodes``)"""
+
+    def __init__(self):
+        self.stats: Dict[tuple, List] = {}
+
+    def stats_of(self, path: tuple) -> List:
+        """The (mutable) ``[calls, seconds]`` of ``path``"""
+        return self.stats.setdefault(path, [0, 0.0])
+
+    def as_dict(self) -> Dict[str, Tuple[int, float]]:
+        """``{path: (calls, seconds)}``, by decreasing cumulative time"""
+        by_time = sorted(self.stats.items(), key=lambda item: -item[1][1])
+        return {path_str(path): tuple(stats) for path, stats in by_time}
+
+    def table(self) -> str:
+        """The stats, as a table sorted by decreasing cumulative time"""
+        lines = [f'{"calls":>10} {"cumtime (s)":>12} {"per call (us)":>14}  path']
+        for path, (calls, seconds) in self.as_dict().items():
+            per_call = seconds / calls * 1e6 if calls else 0.0
+            path = path or '<root>'
+            lines.append(f'{calls:>10} {seconds:>12.6f} {per_call:>14.2f}  {path}')
+        return '\n'.join(lines)
+
+    def reset(self):
+        self.stats.clear()
+
+
+class Profiled(Node):
+    """A node counting and timing the renders of the node it wraps"""
+
+    __slots__ = ('node', 'stats')
+
+    def __init__(self, node: Node, stats: List):
+        self.node = node
+        self.stats = stats
+        self.params = node.params
+
+    def render(self, kwargs: Kwargs):
+        start = perf_counter()
+        try:
+            return self.node.render(kwargs)
+        finally:
+            self.stats[0] += 1
+            self.stats[1] += perf_counter() - start
+
+    def _repr_arg(self):
+        return self.node
+
+
+def profile_nodes(root: Node, profile: RenderProfile, path: tuple = ()) -> Node:
+    """Wrap the nodes of the plan of ``node`` in ``Profiled`` nodes, recording their
+    stats in ``profile`` under their path: the nodes of dicts (with static keys) and
+    lists are profiled one by one, other nodes as a whole. Nodes taller than
+    ``MAX_RECURSIVE_HEIGHT`` aren't profiled themselves (so their renders can be
+    walked with an explicit stack, see ``iterative_render``), but the lower ones
+    are.
+
+    >>> profile = RenderProfile()
+    >>> plan = profile_nodes(Compiler.compile({'a': ['{x}', 2]}), profile)
+    >>> plan.render({'x': 1})
+    {'a': ['1', 2]}
+    >>> {path: calls for path, (calls, _) in profile.as_dict().items()} == {
+    ...     '': 1, "['a']": 1, "['a'][0]": 1, "['a'][1]": 1
+    ... }
+    True
+    """
+    heights = plan_heights(root)
+
+    def profiled(node: Node, new_node: Node, node_path: tuple) -> Node:
+        if heights[id(node)] > MAX_RECURSIVE_HEIGHT:
+            return new_node
+        return Profiled(new_node, profile.stats_of(node_path))
+
+    slots = _output_slots(root)
+    if slots is None:
+        return profiled(root, root, path)
+    # (node, its slots, its profiled children so far, its key in its parent)
+    stack = [(root, slots, [], None)]
+    while True:
+        node, slots, children, _ = stack[-1]
+        while len(children) < len(slots):
+            key, child = slots[len(children)]
+            child_slots = _output_slots(child)
+            if child_slots is not None:
+                stack.append((child, child_slots, [], key))
+                break
+            child_path = path + tuple(frame[3] for frame in stack[1:]) + (key,)
+            children.append(profiled(child, child, child_path))
+        else:
+            node_path = path + tuple(frame[3] for frame in stack[1:])
+            stack.pop()
+            if type(node) is DictNode:
+                new_node = DictNode(zip((k for k, _ in node.items), children))
+            else:
+                new_node = ListNode(children)
+            new_node = profiled(node, new_node, node_path)
+            if not stack:
+                return new_node
+            stack[-1][2].append(new_node)
+
+
+# types whose equal values render alike: with their type, they key renders exactly
+_exact_key_types = frozenset({str, bytes, int, bool, type(None)})
+
+
+def exact_key(value) -> Hashable:
+    """A key of ``value`` that's equal for values rendering alike, unlike ``value``
+    itself: ``1``, ``1.0`` and ``True`` are equal, and so are ``0.0`` and ``-0.0``.
+    Only strings, bytes, numbers, ``None`` and tuples of them have one (others
+    raise ``TypeError``).
+
+    >>> exact_key((1,)) == exact_key((True,)), exact_key(0.0) == exact_key(-0.0)
+    (False, False)
+    """
+    value_type = type(value)
+    if value_type in _exact_key_types:
+        return value_type, value
+    elif value_type is float:
+        return float, value, math.copysign(1.0, value)
+    elif value_type is complex:
+        return complex, exact_key(value.real), exact_key(value.imag)
+    elif isinstance(value, tuple):
+        return value_type, tuple(map(exact_key, value))
+    raise TypeError(f"{value_type.__name__} values aren't keyed exactly")
+
+
+def lru_memoize(
+    render: Callable[[tuple], Any], maxsize: int, share: bool = False
+) -> Callable[[tuple], Any]:
+    """Memoize ``render``, a function of a tuple of parameter values, keeping the
+    renders of the ``maxsize`` most recently used tuples.
+
+    :param render: The function to memoize
+    :param maxsize: The number of renders to keep
+    :param share: If true, calls with the same values return the same (cached)
+        object, else a cheap copy of it (see ``copier_for``), so that mutating a
+        render can't affect the next ones
+
+    Renders are keyed on the ``exact_key`` of the values, so only tuples of
+    strings, bytes, numbers, ``None`` and tuples of them are cached: others are
+    rendered, but not cached.
+
+    >>> render = lru_memoize(lambda values: {'xs': list(values)}, maxsize=2)
+    >>> render((1, 2)) == render((1, 2)), render((1, 2)) is render((1, 2))
+    (True, False)
+    >>> render.cache_info().hits
+    3
+    >>> render(([1], 2))  # not cached
+    {'xs': [[1], 2]}
+    >>> render((True, 2)), render(((True,), -0.0))  # equal to cached values
+    ({'xs': [True, 2]}, {'xs': [(True,), -0.0]})
+    """
+    if share:
+
+        @lru_cache(maxsize)
+        def cached(key: tuple):
+            return render(key[0])
+
+    else:
+
+        @lru_cache(maxsize)
+        def cached(key: tuple):
+            value = render(key[0])
+            return value, copier_for(value)
+
+    def memoized(values: tuple):
+        types = tuple(map(type, values))
+        if _exact_key_types.issuperset(types):
+            key = (values, types)  # the usual case, kept lean
+        else:
+            try:
+                key = (values, tuple(map(exact_key, values)))
+            except TypeError:
+                return render(values)
+        result = cached(key)
+        if share:
+            return result
+        value, copier = result
+        return copier(value) if copier else value
+
+    memoized.cache_info = cached.cache_info
+    memoized.cache_clear = cached.cache_clear
+    return memoized
+
+
+class Memoized(Node):
+    """A node rendering the node it wraps through an LRU cache (see
+    ``lru_memoize``), keyed by the values of its parameters"""
+
+    __slots__ = ('node', 'cached')
+
+    def __init__(self, node: Node, maxsize: int, share: bool = False):
+        self.node = node
+        self.params = node.params
+        self.cached = lru_memoize(plan_render(node, argument='tuple'), maxsize, share)
+
+    def render(self, kwargs: Kwargs):
+        return self.cached(tuple(map(kwargs.__getitem__, self.params)))
+
+    def _repr_arg(self):
+        return self.node
+
+
+def memoize_nodes(root: Node, maxsize: int, share: bool = False) -> Node:
+    """Wrap the largest templated containers (dicts, lists...) of the plan of
+    ``root`` that don't use all of its parameters in ``Memoized`` nodes, so that
+    renders sharing the values of a subtree's parameters compute it once.
+
+    >>> plan = memoize_nodes(
+    ...     Compiler.compile({'locale': {'lang': '{lang}', 'tags': ['{lang}']}, 'id': '{id}'}),
+    ...     maxsize=16,
+    ... )
+    >>> plan  # doctest: +NORMALIZE_WHITESPACE
+    DictNode(((Const('locale'), Memoized(DictNode(((Const('lang'), FormatStr('{lang}')),
+                                                   (Const('tags'), ListNode((FormatStr('{lang}'),))))))),
+              (Const('id'), FormatStr('{id}'))))
+    >>> for i in range(3):
+    ...     _ = plan.render({'lang': 'en', 'id': i})
+    >>> plan.items[0][1].cached.cache_info().misses
+    1
+    """
+    n_params = len(root.params)
+
+    def memoize(node: Node) -> Optional[Node]:
+        if type(node) is LoopNode:
+            return node  # items (often unhashable) aren't memoized one by one
+        elif node is root or node.assemble is None:
+            return None  # leaves are left as they are
+        elif node.has_params and len(node.params) < n_params:
+            return Memoized(node, maxsize, share)
+        return None
+
+    return transform_plan(root, memoize)
+
+
+def iter_render(node: Node, kwargs: Kwargs) -> Iterator:
+    """Lazily render the items of the container ``node`` renders: the ``(key, value)``
+    pairs of a dict, or the items of a list (or tuple...), one at a time.
+
+    >>> plan = Compiler.compile(['{x}', {'y': '{x}{x}'}])
+    >>> items = iter_render(plan, {'x': 'a'})
+    >>> next(items)
+    'a'
+    >>> next(items)
+    {'y': 'aa'}
+    """
+    if isinstance(node, DictNode):
+        return ((k.render(kwargs), v.render(kwargs)) for k, v in node.items)
+    elif isinstance(node, (ListNode, ConstructNode)):
+        return (render(kwargs) for render in node._renders)
+    elif isinstance(node, LoopNode):
+        return node.iter_items(kwargs)
+    value = node.render(kwargs)
+    return iter(value.items() if isinstance(value, dict) else value)
+
+
+_json_encoder = json.JSONEncoder()
+json_key_literals = {True: 'true', False: 'false', None: 'null'}
+
+
+def json_key(key) -> str:
+    """The string json uses for the dict key ``key`` (json only has string keys)
+
+    >>> json_key(1.5), json_key(True), json_key(None)
+    ('1.5', 'true', 'null')
+    """
+    if isinstance(key, str):
+        return key
+    elif key is None or isinstance(key, bool):
+        return json_key_literals[key]
+    elif isinstance(key, int):
+        return int.__repr__(key)
+    elif isinstance(key, float):
+        return _json_encoder.encode(key)
+    raise TypeError(f'keys must be str, int, float, bool or None, not {type(key)}')
+
+
+def iter_json(
+    node: Node, kwargs: Kwargs, encoder: json.JSONEncoder = _json_encoder
+) -> Iterator[str]:
+    """Lazily render ``node`` as chunks of json text, never holding more than one
+    rendered leaf (item that isn't a dict or list template) in memory.
+
+    >>> plan = Compiler.compile({'items': ['{x}', 1, {'y': None}], 2: '{x}'})
+    >>> ''.join(iter_json(plan, {'x': 'a'}))
+    '{"items": ["a", 1, {"y": null}], "2": "a"}'
+
+    The encoder can't ``indent`` nor ``sort_keys``: the containers of the template
+    are written by ``iter_json``, not by the encoder.
+
+    >>> iter_json(plan, {'x': 'a'}, json.JSONEncoder(indent=2))
+    Traceback (most recent call last):
+      ...
+    ValueError: iter_json supports neither indent nor sort_keys
+    """
+    if encoder.indent is not None or encoder.sort_keys:
+        raise ValueError('iter_json supports neither indent nor sort_keys')
+    return _iter_json(node, kwargs, encoder)
+
+
+def _iter_json(node: Node, kwargs: Kwargs, encoder: json.JSONEncoder) -> Iterator[str]:
+    # iterators of the chunks of the containers being written, which are strings or
+    # the (node, kwargs) of a value to write there (so there's no recursion)
+    stack = [iter([(node, kwargs)])]
+    while stack:
+        for part in stack[-1]:
+            if type(part) is str:
+                yield part
+                continue
+            node, kwargs = part
+            if isinstance(node, (DictNode, ListNode, LoopNode)):
+                stack.append(_json_container_parts(node, kwargs, encoder))
+                break
+            yield from encoder.iterencode(node.render(kwargs))
+        else:
+            stack.pop()
+
+
+def _json_container_parts(node: Node, kwargs: Kwargs, encoder: json.JSONEncoder):
+    item_separator, key_separator = encoder.item_separator, encoder.key_separator
+    if isinstance(node, DictNode):
+        yield '{'
+        for i, (key_node, value_node) in enumerate(node.items):
+            if i:
+                yield item_separator
+            yield encoder.encode(json_key(key_node.render(kwargs)))
+            yield key_separator
+            yield value_node, kwargs
+        yield '}'
+    elif isinstance(node, ListNode):
+        yield '['
+        for i, item_node in enumerate(node.items):
+            if i:
+                yield item_separator
+            yield item_node, kwargs
+        yield ']'
+    else:
+        yield '['
+        scope = dict(kwargs)
+        # (the item is written before the next one is put in scope)
+        for i, scope[node.item] in enumerate(kwargs[node.param]):
+            if i:
+                yield item_separator
+            yield node.node, scope
+        yield ']'
+
+
+def dump_json(
+    node: Node,
+    fp,
+    kwargs: Kwargs,
+    *,
+    encoder: json.JSONEncoder = _json_encoder,
+    chunk_size: int = 2 ** 16,
+    encoding: Optional[str] = None,
+):
+    """Render ``node`` as json, written to the file-like ``fp`` in chunks of about
+    ``chunk_size`` characters (encoded with ``encoding``, if given, for binary files
+    and sockets).
+
+    >>> import io
+    >>> fp = io.BytesIO()
+    >>> dump_json(Compiler.compile(['{x}'] * 3), fp, {'x': 'a'}, encoding='utf-8')
+    >>> fp.getvalue()
+    b'["a", "a", "a"]'
+    """
+    buffer, buffered = [], 0
+    for chunk in iter_json(node, kwargs, encoder):
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= chunk_size:
+            _write_chunk(fp, ''.join(buffer), encoding)
+            buffer, buffered = [], 0
+    if buffer:
+        _write_chunk(fp, ''.join(buffer), encoding)
+
+
+def _write_chunk(fp, chunk: str, encoding: Optional[str]):
+    fp.write(chunk.encode(encoding) if encoding else chunk)
+
+
+def kwargs_of_tuple(params: Sequence[str], row: Sequence) -> dict:
+    return dict(zip(params, row))
+
+
+def kwargs_of_record(params: Sequence[str], record) -> dict:
+    return {param: getattr(record, param) for param in params}
+
+
+# what render functions can take as their argument, and how to make kwargs of it
+render_arguments = {
+    'kwargs': None,
+    'tuple': kwargs_of_tuple,
+    'record': kwargs_of_record,
+}
+
+
+def plan_render(root: Node, *, argument: str = 'kwargs') -> Callable[[Any], Any]:
+    """The function rendering the plan of ``root`` from a kwargs mapping (or, with
+    ``argument='tuple'``, a tuple of values ordered like the parameters, or, with
+    ``argument='record'``, an object having them as attributes)
+
+    >>> root = Compiler.compile({'id': '{id}', 'label': '{name}-{id}'})
+    >>> plan_render(root, argument='tuple')((1, 'a'))
+    {'id': '1', 'label': 'a-1'}
+    """
+    if argument not in render_arguments:
+        raise ValueError(f'argument should be in {list(render_arguments)}')
+    render = iterative_render(root)  # root.render, unless the plan is very deep
+    if argument == 'kwargs':
+        return render
+    to_kwargs = partial(render_arguments[argument], root.params)
+    return lambda row: render(to_kwargs(row))
+
+
+def _recompile(cls, template, compile_kwargs):
+    return cls(template, **compile_kwargs)
+
+
+# the compiled template of a render_parallel worker process
+_worker_template: Optional['CompiledTemplate'] = None
+
+
+def _set_worker_template(template: 'CompiledTemplate'):
+    global _worker_template
+    _worker_template = template
+
+
+def _render_chunk_in_worker(names, rows) -> list:
+    return list(_worker_template._render_rows(names, rows))
+
+
+# the options CompiledTemplate reprs show, when they're set
+_repr_options = (
+    'whole_values',
+    'profile',
+    'memoize',
+    'memoize_subtrees',
+    'share_memoized',
+)
+
+
+class CompiledTemplate:
+    """A callable rendering a template through a compiled render plan.
+
+    :param template: The template to compile
+    :param compiler: The ``Compiler`` (class) to compile ``template`` with
+    :param mk_render: Makes the function rendering from a kwargs mapping, given the
+        root node of the plan (e.g. ``plan_render`` or ``embody.codegen.codegen_render``).
+        For ``from_tuple`` and ``from_record``, it's also called with an ``argument``
+        keyword (``'tuple'`` or ``'record'``, see ``plan_render``).
+    :param fold: How to fold the parts of the template that don't depend on any
+        parameter (see ``fold_constants``): ``'copy'`` (default) renders a fresh
+        (cheap) copy of them, ``'share'`` renders the same objects every time (so
+        mutating a render would affect the next ones), and ``None`` doesn't fold.
+    :param profile: If true, renders of calls (``g(...)``, ``render_many``...)
+        record call counts and cumulative times per template path in the
+        ``profile`` attribute (a ``RenderProfile``). Off, it costs nothing.
+    :param whole_values: If true, strings that are a single, bare field (like
+        ``'{x}'``) render to the parameter value itself, by reference, instead of
+        its ``str`` (see ``whole_value_params``)
+    :param memoize: If given, renders are memoized in an LRU cache of ``memoize``
+        renders (the ``render_cache`` attribute, see ``lru_memoize``), keyed by the
+        values of the parameters (only renders of strings, numbers... are cached,
+        see ``exact_key``)
+    :param memoize_subtrees: If given, the largest templated subtrees that don't use
+        all the parameters are memoized, each in an LRU cache of
+        ``memoize_subtrees`` renders (see ``memoize_nodes``)
+    :param share_memoized: If true, memoized renders are returned as they are, so
+        are shared by the calls with the same values, else (default) as cheap
+        copies
+    :param render_options: Passed on to ``mk_render`` (e.g. the ``encoding`` and
+        ``ensure_ascii`` of ``embody.json_render.json_render``)
+
+    >>> g = CompiledTemplate({'static': [1, 2], 'x': '{x}'})
+    >>> g(x=1)['static'] is g(x=1)['static']
+    False
+    >>> g = CompiledTemplate({'static': [1, 2], 'x': '{x}'}, fold='share')
+    >>> g(x=1)['static'] is g(x=1)['static']
+    True
+
+    ``bound`` holds values of parameters to substitute at compile time (see
+    ``partial``).
+
+    Compiled templates pickle by value: the template and compile options are
+    pickled, and the template is compiled again when unpickled.
+
+    >>> import pickle
+    >>> pickle.loads(pickle.dumps(g))(x=2)
+    {'static': [1, 2], 'x': '2'}
+
+    With ``whole_values``, values pass through, with no formatting nor copying:
+
+    >>> g = CompiledTemplate({'data': '{x}', 'label': 'x={x}'}, whole_values=True)
+    >>> x = [1.5, 2.5]
+    >>> g(x=x)
+    {'data': [1.5, 2.5], 'label': 'x=[1.5, 2.5]'}
+    >>> g(x=x)['data'] is x
+    True
+
+    With ``profile``, renders are counted and timed per template path:
+
+    >>> g = CompiledTemplate({'hi': '{name}', 'how are you': ['{verb}', 2]}, profile=True)
+    >>> for name in ('Ann', 'Bo'):
+    ...     _ = g(name=name, verb='run')
+    >>> sorted((path, calls) for path, (calls, seconds) in g.profile.as_dict().items())
+    [('', 2), ("['hi']", 2), ("['how are you']", 2), ("['how are you'][0]", 2), ("['how are you'][1]", 2)]
+
+    With ``memoize``, renders for values seen recently are copies of a cached
+    render:
+
+    >>> g = CompiledTemplate({'locale': '{lang}', 'tier': ['{tier}']}, memoize=128)
+    >>> g(lang='en', tier='pro')
+    {'locale': 'en', 'tier': ['pro']}
+    >>> g(lang='en', tier='pro') is g(lang='en', tier='pro')
+    False
+    >>> g.render_cache.cache_info().hits, g.render_cache.cache_info().misses
+    (2, 1)
+
+    Values are cached with their types, so values that are equal but render
+    differently don't share renders:
+
+    >>> g(lang=1, tier='pro'), g(lang=True, tier='pro')
+    ({'locale': '1', 'tier': ['pro']}, {'locale': 'True', 'tier': ['pro']})
+    """
+
+    def __init__(
+        self,
+        template,
+        compiler=Compiler,
+        mk_render=plan_render,
+        fold: Optional[str] = 'copy',
+        bound: Optional[Kwargs] = None,
+        whole_values: bool = False,
+        profile: bool = False,
+        memoize: Optional[int] = None,
+        memoize_subtrees: Optional[int] = None,
+        share_memoized: bool = False,
+        **render_options,
+    ):
+        self.template = template
+        self._compile_kwargs = dict(
+            compiler=compiler,
+            mk_render=mk_render,
+            fold=fold,
+            bound=bound,
+            whole_values=whole_values,
+            profile=profile,
+            memoize=memoize,
+            memoize_subtrees=memoize_subtrees,
+            share_memoized=share_memoized,
+            **render_options,
+        )
+        self._render_options = render_options
+        self.root = compiler.compile(template)
+        if whole_values:
+            self.root = whole_value_params(self.root)
+        if bound:
+            unknown = bound.keys() - set(self.root.params)
+            if unknown:
+                raise TypeError(f'Not parameters of the template: {sorted(unknown)}')
+            self.root = bind_params(self.root, bound)
+        if fold is not None:
+            if fold not in ('copy', 'share'):
+                raise ValueError(f"fold should be 'copy', 'share' or None: {fold!r}")
+            self.root = fold_constants(self.root, copy=(fold == 'copy'))
+        self.__signature__ = Signature(
+            [Parameter(p, Parameter.KEYWORD_ONLY) for p in self.root.params]
+        )
+        # the plan renders are made from: the root, with its render-time wrappers
+        self._plan = self.root
+        if memoize_subtrees:
+            self._plan = memoize_nodes(self._plan, memoize_subtrees, share_memoized)
+        self.profile = None
+        if profile:
+            self.profile = RenderProfile()
+            self._plan = profile_nodes(self._plan, self.profile)
+        self.render_cache = None
+        if memoize:
+            # one cache, keyed by the tuple of values, for all argument styles
+            tuple_render = mk_render(self._plan, argument='tuple', **render_options)
+            self.render_cache = lru_memoize(tuple_render, memoize, share_memoized)
+        # render from a kwargs mapping
+        self.render = self._mk_render('kwargs')
+        self._tuple_render = None
+        self._record_render = None
+        self._rerenderer = None
+        self._fill_plan = None
+
+    def __call__(self, **kwargs):
+        return self.render(kwargs)
+
+    def __reduce__(self):
+        return _recompile, (type(self), self.template, self._compile_kwargs)
+
+    @property
+    def params(self) -> Tuple[str, ...]:
+        """The names of the parameters of the template, in signature order"""
+        return self.root.params
+
+    def from_tuple(self, row: Sequence):
+        """Render the template from a sequence of values, ordered like ``params``.
+
+        Values are read straight from ``row`` (with the ``codegen`` and ``json``
+        backends, no kwargs dict is made).
+
+        >>> g = CompiledTemplate({'id': '{id}', 'label': '{name}-{id}'})
+        >>> g.params
+        ('id', 'name')
+        >>> g.from_tuple((1, 'a'))
+        {'id': '1', 'label': 'a-1'}
+        """
+        if self._tuple_render is None:
+            self._tuple_render = self._mk_render('tuple')
+        return self._tuple_render(row)
+
+    def from_record(self, record):
+        """Render the template from an object having the parameters as attributes
+        (e.g. a namedtuple, a dataclass instance or an ORM row).
+
+        >>> from collections import namedtuple
+        >>> g = CompiledTemplate({'id': '{id}', 'label': '{name}-{id}'})
+        >>> Row = namedtuple('Row', 'name id extra')
+        >>> g.from_record(Row('a', 1, 'ignored'))
+        {'id': '1', 'label': 'a-1'}
+        """
+        if self._record_render is None:
+            self._record_render = self._mk_render('record')
+        return self._record_render(record)
+
+    def _mk_render(self, argument: str):
+        cache, params = self.render_cache, self.params
+        if cache is None:
+            mk_render = self._compile_kwargs['mk_render']
+            return mk_render(self._plan, argument=argument, **self._render_options)
+        elif argument == 'kwargs':
+            return lambda kwargs: cache(tuple(map(kwargs.__getitem__, params)))
+        elif argument == 'tuple':
+            return lambda row: cache(tuple(row))
+        return lambda record: cache(tuple(getattr(record, p) for p in params))
+
+    def render_many(
+        self, rows: Union[Iterable[Union[Kwargs, tuple]], Mapping[str, Iterable]]
+    ) -> Iterator:
+        """Lazily render the template for every row of ``rows``.
+
+        ``rows`` can be an iterable of kwargs mappings, an iterable of tuples of
+        values ordered like the signature, or a columnar mapping of parameter names
+        to equal-length sequences of values.
+
+        >>> g = CompiledTemplate({'greeting': 'hi {name}', 'ages': ['{age}']})
+        >>> list(g.render_many([{'name': 'Ann', 'age': 3}, {'name': 'Bo', 'age': 4}]))
+        [{'greeting': 'hi Ann', 'ages': ['3']}, {'greeting': 'hi Bo', 'ages': ['4']}]
+        >>> list(g.render_many([('Ann', 3), ('Bo', 4)]))
+        [{'greeting': 'hi Ann', 'ages': ['3']}, {'greeting': 'hi Bo', 'ages': ['4']}]
+        >>> list(g.render_many({'name': ['Ann', 'Bo'], 'age': [3, 4]}))
+        [{'greeting': 'hi Ann', 'ages': ['3']}, {'greeting': 'hi Bo', 'ages': ['4']}]
+        """
+        return self._render_rows(*self._names_and_rows(rows))
+
+    def _names_and_rows(self, rows) -> Tuple[Optional[Tuple[str, ...]], Iterator]:
+        """The parameter names the values of the rows are for (``None`` if rows are
+        kwargs mappings), and an iterator over the rows"""
+        if isinstance(rows, Mapping):
+            return tuple(rows), zip(*rows.values())
+        rows = iter(rows)
+        first_row = next(rows, None)
+        if first_row is None:
+            return None, iter(())
+        rows = chain([first_row], rows)
+        if isinstance(first_row, Mapping):
+            return None, rows
+        return self.params, rows
+
+    def _render_rows(self, names: Optional[Tuple[str, ...]], rows: Iterable):
+        if names is None:
+            return map(self.render, rows)
+        if names == self.params:
+            return map(self.from_tuple, rows)
+        # the loop is all in C: zip names to values, make a dict, render it
+        return map(self.render, map(dict, map(zip, repeat(names), rows)))
+
+    def render_columns(self, columns: Mapping[str, Iterable], *, records: bool = True):
+        """Render the template for every row of ``columns`` (a mapping of parameter
+        names to equal-length arrays, lists, pandas series...), rendering each string
+        leaf a whole column at a time, with numpy (see ``embody.columnar``).
+
+        :param records: If true (default), return the list of renders, else a dict
+            mapping the path of each templated leaf to its column of renders
+
+        >>> g = CompiledTemplate({'name': '{first} {last}', 'n': 1})
+        >>> g.render_columns({'first': ['Ann', 'Bo'], 'last': ['Li', 'Ma']})
+        [{'name': 'Ann Li', 'n': 1}, {'name': 'Bo Ma', 'n': 1}]
+        """
+        from embody.columnar import render_columns  # numpy is optional
+
+        return render_columns(self.root, columns, records=records)
+
+    def render_parallel(
+        self,
+        rows: Union[Iterable[Union[Kwargs, tuple]], Mapping[str, Iterable]],
+        workers: Optional[int] = None,
+        chunksize: int = 1000,
+    ) -> Iterator:
+        """Render the template for every row of ``rows`` (as ``render_many`` does),
+        spreading the rows over ``workers`` processes, by chunks of ``chunksize``.
+
+        The compiled template is sent once to each worker process (where it's compiled
+        again), and renders are yielded in the order of the rows. At most two chunks
+        per worker are in flight at a time, so ``rows`` is read as renders are
+        consumed, not all at once.
+
+        >>> g = CompiledTemplate({'n': '{n}'})
+        >>> list(g.render_parallel([(i,) for i in range(5)], workers=2, chunksize=2))
+        [{'n': '0'}, {'n': '1'}, {'n': '2'}, {'n': '3'}, {'n': '4'}]
+        """
+        names, rows = self._names_and_rows(rows)
+        chunks = iter(lambda: list(islice(rows, chunksize)), [])
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(
+            workers, initializer=_set_worker_template, initargs=(self,)
+        ) as executor:
+            submit = partial(executor.submit, _render_chunk_in_worker, names)
+            pending = deque(map(submit, islice(chunks, max_pending)))
+            while pending:
+                renders = pending.popleft().result()
+                pending.extend(map(submit, islice(chunks, 1)))
+                yield from renders
+
+    def partial(self, **bound_kwargs) -> 'CompiledTemplate':
+        """A compiled template with the values of ``bound_kwargs`` substituted at
+        compile time, whose signature only has the remaining parameters.
+
+        Strings whose fields are all bound become constants, and the parts of the
+        template that are then parameter-free are folded.
+
+        >>> g = CompiledTemplate({'url': '{host}/{path}', 'tenant': ['{tenant}', 1]})
+        >>> g_tenant = g.partial(host='h.com', tenant='acme')
+        >>> g_tenant
+        CompiledTemplate({'url': '{host}/{path}', 'tenant': ['{tenant}', 1]}, bound={'host': 'h.com', 'tenant': 'acme'})
+        >>> str(g_tenant.__signature__)
+        '(*, path)'
+        >>> g_tenant(path='home')
+        {'url': 'h.com/home', 'tenant': ['acme', 1]}
+        >>> g_tenant.root  # doctest: +NORMALIZE_WHITESPACE
+        DictNode(((Const('url'), FormatStr('h.com/{path}')),
+                  (Const('tenant'), ConstCopy(['acme', 1]))))
+        """
+        bound = {**(self._compile_kwargs['bound'] or {}), **bound_kwargs}
+        return type(self)(self.template, **{**self._compile_kwargs, 'bound': bound})
+
+    @property
+    def dependency_index(self) -> Dict[str, List[tuple]]:
+        """Map each parameter to the paths of the parts of the render depending on
+        it (see ``dependency_index``)"""
+        return dependency_index(self.root)
+
+    def rerender(self, previous_output, previous_kwargs: Kwargs, /, **changed_kwargs):
+        """Render the template with ``previous_kwargs`` updated with
+        ``changed_kwargs``, recomputing only the parts of ``previous_output`` (the
+        render of ``previous_kwargs``) that depend on the changed parameters.
+
+        The parts that don't are reused: the new render shares them with
+        ``previous_output``, which is left unchanged.
+
+        >>> g = CompiledTemplate({'title': '{title}', 'body': ['{text}', {'by': '{by}'}]})
+        >>> kwargs = dict(title='T', text='hello', by='Ann')
+        >>> doc = g(**kwargs)
+        >>> new_doc = g.rerender(doc, kwargs, text='bye')
+        >>> new_doc
+        {'title': 'T', 'body': ['bye', {'by': 'Ann'}]}
+        >>> new_doc['body'][1] is doc['body'][1]  # not re-rendered
+        True
+        >>> doc
+        {'title': 'T', 'body': ['hello', {'by': 'Ann'}]}
+
+        Renders of backends rendering text (like ``'json'``) have no parts to reuse:
+        the template is rendered again.
+        """
+        kwargs = {**previous_kwargs, **changed_kwargs}
+        if getattr(self._compile_kwargs['mk_render'], 'renders_text', False):
+            return self.render(kwargs)
+        if self._rerenderer is None:
+            self._rerenderer = _Rerenderer(self.root)
+        return self._rerenderer.rerender(
+            self.root, previous_output, kwargs, set(changed_kwargs)
+        )
+
+    def render_into(self, target, /, **kwargs):
+        """Render the template into ``target``, a previous render (of the same
+        shape), overwriting only its templated parts, instead of allocating a new
+        render. Returns ``target``.
+
+        >>> g = CompiledTemplate({'ts': '{ts}', 'static': {'v': 1}, 'px': ['{bid}', '{ask}']})
+        >>> msg = g(ts=1, bid=9, ask=10)
+        >>> g.render_into(msg, ts=2, bid=8, ask=11) is msg
+        True
+        >>> msg
+        {'ts': '2', 'static': {'v': 1}, 'px': ['8', '11']}
+        """
+        if self._fill_plan is None:
+            self._fill_plan = fill_plan(self.root)
+            if self._fill_plan is None:
+                raise TypeError(
+                    'Only dict (with static keys) and list templates render in place'
+                )
+        if not fits(self._fill_plan, target):
+            raise ValueError("target doesn't have the shape of the template's renders")
+        render_into(self._fill_plan, target, kwargs)
+        return target
+
+    async def arender(self, **kwargs):
+        """Render the template, where parameter values can be awaitables (e.g.
+        coroutines of async lookups).
+
+        Distinct awaitables are awaited exactly once (even if given for several
+        parameters), all concurrently, so the render waits for the slowest of them
+        rather than for their sum.
+
+        >>> import asyncio
+        >>> async def lookup(value, seconds):
+        ...     await asyncio.sleep(seconds)
+        ...     return value
+        >>> g = CompiledTemplate({'user': '{user}', 'greeting': 'hi {user}', 'n': '{n}'})
+        >>> asyncio.run(g.arender(user=lookup('Ann', 0.01), n=3))
+        {'user': 'Ann', 'greeting': 'hi Ann', 'n': '3'}
+        """
+        awaitables = {id(v): v for v in kwargs.values() if isawaitable(v)}
+        if awaitables:
+            values = dict(zip(awaitables, await asyncio.gather(*awaitables.values())))
+            kwargs = {
+                name: values[id(v)] if isawaitable(v) else v
+                for name, v in kwargs.items()
+            }
+        return self.render(kwargs)
+
+    def iter_render(self, kwargs: Kwargs) -> Iterator:
+        """Lazily render the items of the rendered container (see ``iter_render``).
+
+        >>> g = CompiledTemplate(['{x}', '{x}{x}'])
+        >>> list(g.iter_render({'x': 'a'}))
+        ['a', 'aa']
+        """
+        return iter_render(self.root, kwargs)
+
+    def iter_json(self, kwargs: Kwargs, **json_kwargs) -> Iterator[str]:
+        """Lazily render json text chunks (see ``iter_json``). ``json_kwargs`` are
+        passed on to ``json.JSONEncoder``."""
+        encoder = json.JSONEncoder(**json_kwargs) if json_kwargs else _json_encoder
+        return iter_json(self.root, kwargs, encoder)
+
+    def dump_json(
+        self,
+        fp,
+        kwargs: Kwargs,
+        *,
+        chunk_size: int = 2 ** 16,
+        encoding: Optional[str] = None,
+        **json_kwargs,
+    ):
+        """Render json to the file-like ``fp``, in chunks (see ``dump_json``), so that
+        memory stays proportional to the largest leaf rather than the whole document.
+
+        >>> import io
+        >>> fp = io.StringIO()
+        >>> CompiledTemplate({'rows': ['{x}'] * 3}).dump_json(fp, {'x': 1})
+        >>> fp.getvalue()
+        '{"rows": ["1", "1", "1"]}'
+        """
+        encoder = json.JSONEncoder(**json_kwargs) if json_kwargs else _json_encoder
+        dump_json(
+            self.root,
+            fp,
+            kwargs,
+            encoder=encoder,
+            chunk_size=chunk_size,
+            encoding=encoding,
+        )
+
+    def __repr__(self):
+        bound = self._compile_kwargs['bound']
+        options = f', bound={bound!r}' if bound else ''
+        for option in _repr_options:
+            if self._compile_kwargs[option]:
+                options += f', {option}={self._compile_kwargs[option]!r}'
+        for option, value in self._render_options.items():
+            options += f', {option}={value!r}'
+        return f'{type(self).__name__}({self.template!r}{options})'
@@ -0,0 +1,183 @@
+"""Format strings parsed into literal and field segments
+
+The field names ``string.Formatter().parse`` gives are raw, like ``'user.name'``
+or ``'row[0]'``, rather than the parameters they use (``'user'`` and ``'row'``).
+Here, a format string is parsed into literals and fields, each field knowing its
+parameter, its attribute and index path, its conversion and its format spec.
+
+The parameters of a format string are extracted once, when its render function is
+made. A string that is a single field then renders it directly, without parsing,
+but other strings are rendered by ``str.format_map``, which parses them again on
+every call.
+
+>>> render = format_string_func('{user.name!r:>7} paid {amounts[0]:.2f}')
+>>> render.params
+('user', 'amounts')
+>>> from types import SimpleNamespace
+>>> render({'user': SimpleNamespace(name='Ann'), 'amounts': [3.14159]})
+"  'Ann' paid 3.14"
+
+Format specs can have fields of their own:
+
+>>> render = format_string_func('{x:>{width}}|')
+>>> render.params
+('x', 'width')
+>>> render({'x': 1, 'width': 3})
+'  1|'
+"""
+
+import re
+import string
+from functools import partial
+from typing import Any, Callable, Mapping, Optional, Tuple, Union
+
+Kwargs = Mapping[str, Any]
+
+# the first name of a field name, and the attribute and index accesses following it
+_field_first_name = re.compile(r'[^.[]*')
+_field_path_part = re.compile(r'\.([^.[]+)|\[([^\]]+)\]')
+_conversions = {None: None, 'r': repr, 's': str, 'a': ascii}
+
+
+def split_field_name(field_name: str) -> Tuple[str, Tuple[Tuple[bool, Any], ...]]:
+    """The parameter of a field name, and the path of ``(is_attribute, key)`` pairs
+    to get from it to the value of the field (``str.format`` semantics: digit
+    indices are ints, other indices are strings).
+
+    >>> split_field_name('row[0].name[key]')
+    ('row', ((False, 0), (True, 'name'), (False, 'key')))
+    >>> split_field_name('0')
+    Traceback (most recent call last):
+      ...
+    ValueError: Positional fields aren't supported: '0'
+    """
+    first = _field_first_name.match(field_name).group()
+    rest = field_name[len(first) :]
+    if not first or first.isdigit():
+        raise ValueError(f"Positional fields aren't supported: {field_name!r}")
+    path = []
+    position = 0
+    while position < len(rest):
+        match = _field_path_part.match(rest, position)
+        if match is None:
+            raise ValueError(f'Invalid field name: {field_name!r}')
+        attribute, key = match.groups()
+        if attribute is not None:
+            path.append((True, attribute))
+        else:
+            path.append((False, int(key) if key.isdigit() else key))
+        position = match.end()
+    return first, tuple(path)
+
+
+class FormatField:
+    """A replacement field of a format string, rendering (to a string) from a kwargs
+    mapping"""
+
+    __slots__ = ('param', 'path', 'conversion', 'format_spec', 'params', 'render')
+
+    def __init__(self, field_name: str, conversion: Optional[str], format_spec: str):
+        self.param, self.path = split_field_name(field_name)
+        if conversion not in _conversions:
+            raise ValueError(f'Unknown conversion: {conversion!r}')
+        self.conversion = conversion
+        params = (self.param,)
+        if '{' in format_spec:
+            format_spec = format_string_func(format_spec)
+            params += format_spec.params
+        self.format_spec = format_spec
+        self.params = tuple(dict.fromkeys(params))
+        self.render = self._mk_render()
+
+    def _mk_render(self) -> Callable[[Kwargs], str]:
+        param, path, format_spec = self.param, self.path, self.format_spec
+        convert = _conversions[self.conversion]
+        if not path and convert is None and isinstance(format_spec, str):
+            # the usual case, kept lean
+
+            def render(kwargs):
+                return format(kwargs[param], format_spec)
+
+        else:
+
+            def render(kwargs):
+                value = kwargs[param]
+                for is_attribute, key in path:
+                    value = getattr(value, key) if is_attribute else value[key]
+                if convert is not None:
+                    value = convert(value)
+                if isinstance(format_spec, str):
+                    return format(value, format_spec)
+                return format(value, format_spec(kwargs))
+
+        return render
+
+    def __repr__(self):
+        conversion = f'!{self.conversion}' if self.conversion else ''
+        return f'<{type(self).__name__} {self.param}{conversion}>'
+
+
+Segment = Union[str, FormatField]
+
+
+def parse_format_string(template: str) -> Tuple[Segment, ...]:
+    """The literal (str) and field (``FormatField``) segments of ``template``.
+
+    >>> parse_format_string('{{{a}}} and {b!r}')
+    ('{', <FormatField a>, '} and ', <FormatField b!r>)
+    """
+    segments = []
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(
+        template
+    ):
+        if literal and segments and isinstance(segments[-1], str):
+            segments[-1] += literal  # escaped braces split literals
+        elif literal:
+            segments.append(literal)
+        if field_name is not None:
+            segments.append(FormatField(field_name, conversion, format_spec))
+    return tuple(segments)
+
+
+def format_string_params(template: str) -> Tuple[str, ...]:
+    """The (unique) parameters the fields of ``template`` use, in order.
+
+    >>> format_string_params('{user.name} {row[0]} {user!r:{width}}')
+    ('user', 'row', 'width')
+    """
+    return _segments_params(parse_format_string(template))
+
+
+def _segments_params(segments) -> Tuple[str, ...]:
+    return tuple(
+        dict.fromkeys(
+            param
+            for segment in segments
+            if not isinstance(segment, str)
+            for param in segment.params
+        )
+    )
+
+
+def format_string_func(template: str) -> Callable[[Kwargs], str]:
+    """A function rendering ``template`` from a kwargs mapping, like
+    ``template.format_map``. The function has a ``params`` attribute, extracted
+    once, here.
+
+    A string that is a single field renders that field directly. Others are rendered
+    by ``format_map``, which parses the template again on every call: its parse, in
+    C, costs less than joining the segments in python would.
+
+    >>> render = format_string_func('{a} and {b} and {a}')
+    >>> render({'a': 1, 'b': 2}), render.params
+    ('1 and 2 and 1', ('a', 'b'))
+    >>> format_string_func('{a.imag:.1f}')({'a': 2j})
+    '2.0'
+    """
+    segments = parse_format_string(template)
+    if len(segments) == 1 and not isinstance(segments[0], str):
+        render = segments[0].render
+    else:
+        render = partial(str.format_map, template)
+    render.params = _segments_params(segments)
+    return render
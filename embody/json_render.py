@@ -0,0 +1,201 @@
+"""Render templates directly to json text
+
+Most rendered templates end up in ``json.dumps``. Here, the static skeleton of a
+template is serialized once, at compile time, into text fragments, leaving holes
+for the parts depending on parameters. A render then only encodes the values of
+the holes, and joins them with the fragments: no intermediate dicts and lists are
+built, and there's nothing left for the json encoder to walk.
+
+>>> from embody.compiled import Compiler
+>>> template = {
+...     'hello': '{name}',
+...     'how are you': ['{verb}', 2, '{name} and {verb} again']
+... }
+>>> render = json_render(Compiler.compile(template))
+>>> render({'name': 'NAME', 'verb': 'VERB'})
+'{"hello": "NAME", "how are you": ["VERB", 2, "NAME and VERB again"]}'
+>>> print(render.source, end='')  # doctest: +NORMALIZE_WHITESPACE
+def render(kwargs):
+    return ''.join(('{"hello": ', _obj0(f"{kwargs['name']}"), ', "how are you": [',
+                    _obj1(f"{kwargs['verb']}"), ', 2, ',
+                    _obj2(f"{kwargs['name']} and {kwargs['verb']} again"), ']}'))
+
+It's the ``'json'`` backend of ``Templater.template_func``:
+
+>>> from embody.templater import Templater
+>>> g = Templater.template_func({'x': ['{x}', None]}, backend='json')
+>>> g(x='"quoted"')
+'{"x": ["\\\\"quoted\\\\"", null]}'
+
+Its options (those of ``json_render``) are compile options, and pickle with it:
+
+>>> import pickle
+>>> g = Templater.template_func(
+...     ['{x}'], backend='json', encoding='utf-8', ensure_ascii=False
+... )
+>>> pickle.loads(pickle.dumps(g))(x='é')
+b'["\\xc3\\xa9"]'
+"""
+
+import json
+from json.encoder import encode_basestring, encode_basestring_ascii
+from typing import Any, Callable, List, Optional, Tuple
+
+from embody.compiled import (
+    Node,
+    Const,
+    ConstCopy,
+    FormatStr,
+    DictNode,
+    ListNode,
+    ConstructNode,
+    LoopNode,
+    json_key,
+)
+from embody.codegen import (
+    SourceBuilder,
+    compile_render_function,
+    render_function_source,
+)
+
+# a part of the json text: (True, static text) or (False, python expression)
+JsonPart = Tuple[bool, str]
+
+
+def is_json_key(key) -> bool:
+    return key is None or isinstance(key, (str, int, float))
+
+
+class _JsonSkeleton:
+    """Collects the parts of the json text of a plan"""
+
+    def __init__(self, encoder: json.JSONEncoder, builder: SourceBuilder):
+        self.encoder = encoder
+        self.encode_str = (
+            encode_basestring_ascii if encoder.ensure_ascii else encode_basestring
+        )
+        self.builder = builder
+        self.parts: List[JsonPart] = []
+
+    def static(self, text: str):
+        self.parts.append((True, text))
+
+    def hole(self, expr: str):
+        self.parts.append((False, expr))
+
+    def add(self, node: Node):
+        node_type = type(node)
+        if node_type in (Const, ConstCopy):
+            try:
+                self.static(self.encoder.encode(node.value))
+            except (TypeError, ValueError):
+                # not json serializable: fail when rendering, as json.dumps would
+                encode = self.builder.bind(self.encoder.encode)
+                self.hole(f'{encode}({self.builder.bind(node.value)})')
+        elif node_type is FormatStr:
+            encode_str = self.builder.bind(self.encode_str)
+            self.hole(f'{encode_str}({self.builder.expr(node)})')
+        elif node_type is DictNode and all(
+            type(k) is Const and is_json_key(k.value) for k, _ in node.items
+        ):
+            self.add_dict(node)
+        elif node_type is ListNode or (
+            node_type is ConstructNode and node.make is tuple
+        ):
+            self.add_sequence(node.items)
+        elif node_type is LoopNode:
+            self.add_loop(node)
+        else:
+            # dicts with templated keys (that could collide), sets, dataclasses...
+            # are rendered, then encoded
+            encode = self.builder.bind(self.encoder.encode)
+            self.hole(f'{encode}({self.builder.expr(node)})')
+
+    def add_dict(self, node: DictNode):
+        self.static('{')
+        for i, (key_node, value_node) in enumerate(node.items):
+            if i:
+                self.static(self.encoder.item_separator)
+            self.static(self.encode_str(json_key(key_node.value)))
+            self.static(self.encoder.key_separator)
+            self.add(value_node)
+        self.static('}')
+
+    def add_sequence(self, items):
+        self.static('[')
+        for i, item in enumerate(items):
+            if i:
+                self.static(self.encoder.item_separator)
+            self.add(item)
+        self.static(']')
+
+    def add_loop(self, node: LoopNode):
+        # the json of the items is joined, in a comprehension
+        items = _JsonSkeleton(self.encoder, self.builder)
+        values = self.builder.param_expr(node.param)
+        with self.builder.item_scope(node.item) as variable:
+            items.add(node.node)
+            item_expr = items.expr()
+        separator = self.encoder.item_separator
+        self.static('[')
+        self.hole(f'{separator!r}.join([{item_expr} for {variable} in {values}])')
+        self.static(']')
+
+    def expr(self) -> str:
+        """The python expression of the json text"""
+        exprs = []
+        static_text = []
+        for is_static, part in self.parts:
+            if is_static:
+                static_text.append(part)
+            else:
+                if static_text:
+                    exprs.append(repr(''.join(static_text)))
+                    static_text = []
+                exprs.append(part)
+        if static_text:
+            exprs.append(repr(''.join(static_text)))
+        if len(exprs) == 1:
+            return exprs[0]
+        return "''.join((" + ', '.join(exprs) + '))'
+
+
+def json_render(
+    root: Node,
+    *,
+    argument: str = 'kwargs',
+    encoding: Optional[str] = None,
+    **json_kwargs,
+) -> Callable[[Any], Any]:
+    """Make a function rendering the plan of ``root`` directly to json text.
+
+    :param root: The root node of the plan
+    :param argument: What the function takes: ``'kwargs'``, ``'tuple'`` or
+        ``'record'`` (see ``embody.codegen.SourceBuilder``)
+    :param encoding: If given, the function returns bytes, encoded with it
+    :param json_kwargs: Passed on to ``json.JSONEncoder`` (except ``indent`` and
+        ``sort_keys``, which aren't supported)
+
+    >>> from embody.compiled import Compiler
+    >>> render = json_render(
+    ...     Compiler.compile(['{x}', 'é']), encoding='utf-8', ensure_ascii=False
+    ... )
+    >>> render({'x': 1})
+    b'["1", "\\xc3\\xa9"]'
+    """
+    encoder = json.JSONEncoder(**json_kwargs)
+    if encoder.indent is not None or encoder.sort_keys:
+        raise ValueError('json_render supports neither indent nor sort_keys')
+    builder = SourceBuilder(argument, root.params)
+    skeleton = _JsonSkeleton(encoder, builder)
+    skeleton.add(root)
+    expr = skeleton.expr()
+    if encoding is not None:
+        expr = f'{expr}.encode({encoding!r})'
+    return compile_render_function(
+        render_function_source(expr, builder.arg_name), builder.namespace
+    )
+
+
+# its renders are text, which CompiledTemplate.rerender can't rerender by parts
+json_render.renders_text = True
@@ -18,19 +18,52 @@ Born from a
 '(*, name, verb)'
 """
 
-import string
+import copyreg
+import threading
+from dataclasses import fields
 from functools import partial
 from inspect import Signature, Parameter
-from operator import itemgetter
-from typing import Callable, Any, TypeVar, Generator, Tuple, Dict, List, Iterable
-from collections import namedtuple
+from typing import (
+    Callable,
+    Any,
+    TypeVar,
+    Generator,
+    Tuple,
+    Dict,
+    List,
+    Iterable,
+    Hashable,
+    Optional,
+)
+from collections import namedtuple, OrderedDict
+
+from embody.compiled import (
+    CompiledTemplate,
+    Compiler,
+    Dataclass,
+    ForEach,
+    exact_key,
+    Include,
+    Kwargs,
+    Node,
+    plan_render,
+    cached_mro_lookup,
+    container_constructor,
+    index_entries_by_param,
+    positional_constructor,
+    template_items,
+)
+from embody.codegen import codegen_render
+from embody.format_strings import format_string_func
+from embody.json_render import json_render
 
 T = TypeVar('T')
 U = TypeVar('U')
 K = TypeVar('K')
 V = TypeVar('V')
 
-# TODO: Make these things picklable
+# Note: the functions made by the closure backend of Templater.template_func aren't
+# picklable, but the CompiledTemplate instances of the other backends are.
 
 
 def get_generator_return(gen: Generator[T, Any, U]) -> Tuple[Generator[T, Any, U], U]:
@@ -62,21 +95,50 @@ def unique_list_conserving_order(iterable: Iterable) -> list:
 TemplateFunc = Generator[str, None, Callable[..., T]]
 
 
+# the backends of Templater.template_func that compile a render plan, and the
+# function making their render function from the plan's root node
+compiled_backends = {
+    'plan': plan_render,
+    'codegen': codegen_render,
+    'json': json_render,
+}
+
+
 class Templater:
+    """Makes functions rendering templates, dispatching on the template type.
+
+    Handlers registered for a type (with ``register``) are also used for its
+    subclasses, the closest along the MRO winning:
+
+    >>> from collections import OrderedDict
+    >>> rendered = Templater.template_func(OrderedDict(a='{x}'), backend='closure')(x=1)
+    >>> type(rendered).__name__, dict(rendered)
+    ('OrderedDict', {'a': '1'})
+    """
+
     templater_registry: Dict[type, Callable[[Any], TemplateFunc]] = {}
+    # handlers resolved along the MRO, per (templater class, template type)
+    _handler_cache: Dict[Tuple[type, type], Callable[[Any], TemplateFunc]] = {}
 
     @classmethod
     def register(cls, handles_type: type):
         def decorator(f):
             cls.templater_registry[handles_type] = f
+            cls._handler_cache.clear()
             return f
 
         return decorator
 
+    @classmethod
+    def handler(cls, template) -> Optional[Callable[[Any], TemplateFunc]]:
+        return cached_mro_lookup(
+            cls.templater_registry, cls._handler_cache, cls, type(template)
+        )
+
     @classmethod
     def template_func_generator(cls, template: T) -> TemplateFunc[T]:
-        if type(template) in cls.templater_registry:
-            template_factory = cls.templater_registry[type(template)]
+        template_factory = cls.handler(template)
+        if template_factory is not None:
             return template_factory(template)
         else:
             # an empty generator that returns a function that returns the template unchanged,
@@ -88,7 +150,70 @@ class Templater:
             return just_return()
 
     @classmethod
-    def template_func(cls, template: T) -> Callable[..., T]:
+    def template_func(
+        cls, template: T, backend: str = 'plan', **compile_kwargs
+    ) -> Callable[..., T]:
+        """Make a function that renders ``template`` from keyword arguments.
+
+        :param template: The template (e.g. a str, dict or list, possibly nested)
+        :param backend: ``'plan'`` (default) compiles the template once into a render
+            plan (see ``embody.compiled``), and returns a ``CompiledTemplate``, which
+            also has batch rendering methods (e.g. ``render_many``);
+            ``'codegen'`` goes further, generating and compiling the python source of
+            a function rendering the plan in a single expression (see
+            ``embody.codegen``);
+            ``'json'`` renders json text directly, splicing the encoded values of the
+            parameters into the pre-serialized static parts (see
+            ``embody.json_render``);
+            ``'closure'`` returns a plain function nesting one closure per template
+            node, made by the handlers registered with ``register``.
+        :param compile_kwargs: Options of the compiled backends, passed on to
+            ``CompiledTemplate`` (e.g. ``fold``, or the ``encoding`` and
+            ``ensure_ascii`` of the ``'json'`` backend)
+
+        >>> g = Templater.template_func({'x': ['{a}', '{b}']})
+        >>> g(a=1, b=2)
+        {'x': ['1', '2']}
+        >>> str(g.__signature__)
+        '(*, a, b)'
+        >>> list(g.render_many([(1, 2), (3, 4)]))
+        [{'x': ['1', '2']}, {'x': ['3', '4']}]
+        >>> Templater.template_func({'x': ['{a}', '{b}']}, backend='codegen')(a=1, b=2)
+        {'x': ['1', '2']}
+        >>> Templater.template_func({'x': ['{a}', '{b}']}, backend='closure')(a=1, b=2)
+        {'x': ['1', '2']}
+
+        Types with handlers registered with ``register`` are rendered by them, with
+        any backend:
+
+        >>> class Pair:
+        ...     def __init__(self, first, second):
+        ...         self.first, self.second = first, second
+        >>> @Templater.register(Pair)
+        ... def templated_pair_func(template):
+        ...     first = yield from Templater.template_func_generator(template.first)
+        ...     second = yield from Templater.template_func_generator(template.second)
+        ...     def template_func(**kwargs):
+        ...         return (first(x=kwargs['x']), second(y=kwargs['y']))
+        ...     return template_func
+        >>> g = Templater.template_func({'p': Pair('{x}', '{y}')})
+        >>> str(g.__signature__), g(x=1, y=2)
+        ('(*, x, y)', {'p': ('1', '2')})
+        >>> h = Templater.template_func(ForEach('xs', Pair('{x}', '{y}'), item='x'))
+        >>> str(h.__signature__), h(xs=[1, 2], y=3)
+        ('(*, xs, y)', [('1', '3'), ('2', '3')])
+        """
+        if backend in compiled_backends:
+            return CompiledTemplate(
+                template,
+                compiler=compiler_of(cls),
+                mk_render=compiled_backends[backend],
+                **compile_kwargs,
+            )
+        elif backend != 'closure':
+            raise ValueError(f'Unknown backend: {backend!r}')
+        elif compile_kwargs:
+            raise TypeError(f'The closure backend takes no options: {compile_kwargs}')
         gen = cls.template_func_generator(template)
         params, f = get_generator_return(gen)
 
@@ -99,21 +224,120 @@ class Templater:
         return f
 
 
+class TemplaterNode(Node):
+    """A plan node rendering ``template`` with the function made by ``handler``, a
+    ``Templater`` handler"""
+
+    __slots__ = ('template', 'func')
+
+    def __init__(self, template, handler: Callable[[Any], TemplateFunc]):
+        self.template = template
+        params, self.func = get_generator_return(handler(template))
+        self.params = tuple(dict.fromkeys(params))
+
+    def render(self, kwargs: Kwargs):
+        return self.func(**{param: kwargs[param] for param in self.params})
+
+    def _repr_arg(self):
+        return self.template
+
+
+class TemplaterCompiler(Compiler):
+    """A ``Compiler`` for the compiled backends of ``templater``: templates whose
+    ``templater`` handler isn't one ``Compiler`` has an equivalent of (e.g. the
+    handlers of types users registered) are rendered by it (in ``TemplaterNode``
+    nodes).
+
+    If ``templater`` overrides ``template_func_generator``, templates are rendered
+    by it as a whole, in a single ``TemplaterNode`` (so no faster than with the
+    ``'closure'`` backend, but the same).
+
+    >>> class Upper(Templater):
+    ...     @classmethod
+    ...     def template_func_generator(cls, template):
+    ...         func = yield from super().template_func_generator(template)
+    ...         return lambda **kwargs: func(**kwargs).upper()
+    >>> Upper.template_func('{x}')(x='abc')
+    'ABC'
+    >>> Upper.template_func('{x}', backend='closure')(x='abc')
+    'ABC'
+    """
+
+    templater = Templater
+
+    @classmethod
+    def handler(cls, template) -> Optional[Callable[[Any], Node]]:
+        generator = cls.templater.template_func_generator
+        if generator.__func__ is not Templater.template_func_generator.__func__:
+            return partial(TemplaterNode, handler=generator)
+        templater_handler = cls.templater.handler(template)
+        if templater_handler is None or templater_handler in _compiled_handlers:
+            return super().handler(template)
+        return partial(TemplaterNode, handler=templater_handler)
+
+
+_templater_compilers = {Templater: TemplaterCompiler}
+
+
+class _TemplaterCompilerType(type):
+    """The type of the ``TemplaterCompiler`` classes ``compiler_of`` makes, which
+    pickle as ``compiler_of(templater)``"""
+
+    def __reduce__(cls):
+        return compiler_of, (cls.templater,)
+
+
+def compiler_of(templater: type) -> type:
+    """The ``TemplaterCompiler`` (class) of the ``Templater`` (class) ``templater``
+    (made the first time it's asked for, and pickled as ``compiler_of(templater)``,
+    so templates compiled for subclasses of ``Templater`` pickle too)"""
+    if templater not in _templater_compilers:
+        _templater_compilers[templater] = _TemplaterCompilerType(
+            f'{templater.__name__}Compiler',
+            (TemplaterCompiler,),
+            {'templater': templater},
+        )
+    return _templater_compilers[templater]
+
+
+# classes pickle by reference (as a module attribute) whatever their type says,
+# unless their type is in copyreg's dispatch table
+copyreg.pickle(_TemplaterCompilerType, _TemplaterCompilerType.__reduce__)
+
+
 @Templater.register(str)
 def templated_string_func(template: str) -> TemplateFunc[str]:
-    """A function making templated strings. Like template.format, but with a signature"""
-    f = partial(str.format, template)
-    yield from filter(None, map(itemgetter(1), string.Formatter().parse(template)))
+    """A function making templated strings. Like template.format, but with a signature
+    (of the parameters the fields use, extracted once, see
+    ``embody.format_strings``).
+
+    >>> g = Templater.template_func('{user.name}: {scores[0]:.1f}', backend='closure')
+    >>> str(g.__signature__)
+    '(*, user, scores)'
+    >>> from types import SimpleNamespace
+    >>> g(user=SimpleNamespace(name='Ann'), scores=[9.25])
+    'Ann: 9.2'
+    """
+    render = format_string_func(template)
+    yield from render.params
+
+    def f(**kwargs):
+        return render(kwargs)
 
     return f
 
 
 @Templater.register(dict)
 def templated_dict_func(template: Dict[K, V]) -> TemplateFunc[Dict[K, V]]:
-    DictEntryInfo = namedtuple(
-        'DictEntryInfo', ['key_func', 'value_func', 'key_args', 'value_args']
-    )
-    entries: List[DictEntryInfo] = []
+    """Templated dicts. The function made has a ``dependency_index`` attribute,
+    mapping each param to the keys of the entries using it.
+
+    >>> g = Templater.template_func({'a': '{x}', 'b': '{x}{y}'}, backend='closure')
+    >>> g.dependency_index
+    {'x': ('a', 'b'), 'y': ('b',)}
+    """
+    # (key func, value func, key args, value args) of each entry
+    entries: List[Tuple[Callable, Callable, Tuple[str, ...], Tuple[str, ...]]] = []
     for key, value in template.items():
         key_params, key_template_func = get_generator_return(
             Templater.template_func_generator(key)
@@ -121,27 +345,31 @@ def templated_dict_func(template: Dict[K, V]) -> TemplateFunc[Dict[K, V]]:
         value_params, value_template_func = get_generator_return(
             Templater.template_func_generator(value)
         )
-        key_params = tuple(key_params)
-        value_params = tuple(value_params)
+        # unique at each level, so that nested templates don't pass duplicates up
+        key_params = tuple(dict.fromkeys(key_params))
+        value_params = tuple(dict.fromkeys(value_params))
         yield from key_params
         yield from value_params
 
         entries.append(
-            DictEntryInfo(
-                key_template_func, value_template_func, key_params, value_params
-            )
+            (key_template_func, value_template_func, key_params, value_params)
         )
 
     def template_func(**kwargs):
         return {
-            entry_info.key_func(
-                **{arg: kwargs[arg] for arg in entry_info.key_args}
-            ): entry_info.value_func(
-                **{arg: kwargs[arg] for arg in entry_info.value_args}
+            key_func(**{arg: kwargs[arg] for arg in key_args}): value_func(
+                **{arg: kwargs[arg] for arg in value_args}
             )
-            for entry_info in entries
+            for key_func, value_func, key_args, value_args in entries
         }
 
+    if type(template) is not dict:
+        template_func = _retyped_func(template_func, template)
+    # the keys (of template) of the entries using each param
+    template_func.dependency_index = index_entries_by_param(
+        (key, key_args + value_args)
+        for key, (_, _, key_args, value_args) in zip(template, entries)
+    )
     return template_func
 
 
@@ -152,7 +380,7 @@ def templated_list_func(template: List[T]) -> TemplateFunc[List[T]]:
         params, item_template_func = get_generator_return(
             Templater.template_func_generator(item)
         )
-        params = tuple(params)
+        params = tuple(dict.fromkeys(params))
         yield from params
 
         entries.append((item_template_func, params))
@@ -165,4 +393,283 @@ def templated_list_func(template: List[T]) -> TemplateFunc[List[T]]:
             for item_template_func, args in entries
         ]
 
+    if type(template) is not list:
+        template_func = _retyped_func(template_func, template)
+    # the indices of the items using each param
+    template_func.dependency_index = index_entries_by_param(
+        (i, args) for i, (_, args) in enumerate(entries)
+    )
     return template_func
+
+
+def _retyped_func(template_func: Callable, template) -> Callable:
+    """``template_func``, rendering a plain dict or list, made to render the type of
+    ``template`` (see ``container_constructor``)"""
+    construct = container_constructor(template)
+
+    def retyped_template_func(**kwargs):
+        return construct(template_func(**kwargs))
+
+    return retyped_template_func
+
+
+@Templater.register(tuple)
+@Templater.register(set)
+@Templater.register(frozenset)
+@Templater.register(Dataclass)
+def templated_constructed_func(template: T) -> TemplateFunc[T]:
+    """Templated tuples (and namedtuples), sets, frozensets and dataclasses, which
+    render to objects of the same type.
+
+    >>> from collections import namedtuple
+    >>> Point = namedtuple('Point', 'x y')
+    >>> g = Templater.template_func(Point('{x}', ('{y}',)), backend='closure')
+    >>> g(x=1, y=2)
+    Point(x='1', y=('2',))
+    """
+    items_template_func = yield from templated_list_func(template_items(template))
+    make = positional_constructor(type(template))
+
+    def template_func(**kwargs):
+        return make(items_template_func(**kwargs))
+
+    template_func.dependency_index = items_template_func.dependency_index
+    return template_func
+
+
+# the (template, params, function) of the fragments made by the closure backend
+_fragment_funcs: Dict[str, Tuple[Any, Tuple[str, ...], Callable]] = {}
+
+
+@Templater.register(Include)
+def templated_include_func(template: Include) -> TemplateFunc:
+    """The function of the fragment ``template`` stands for (see ``Include``), made
+    once for all the templates including it.
+
+    >>> Compiler.register_fragment('greeting', ['hi {name}', '{n}'])
+    >>> g = Templater.template_func({'a': Include('greeting')}, backend='closure')
+    >>> str(g.__signature__), g(name='Ann', n=1)
+    ('(*, name, n)', {'a': ['hi Ann', '1']})
+    """
+    fragment = Compiler.fragment_registry.get(template.name)
+    cached = _fragment_funcs.get(template.name)
+    if cached is None or cached[0] is not fragment:
+        Compiler.fragment_node(template.name)  # raises if unknown or recursive
+        gen = Templater.template_func_generator(fragment)
+        params, func = get_generator_return(gen)
+        cached = _fragment_funcs[template.name] = (fragment, tuple(params), func)
+    _, params, func = cached
+    yield from params
+    return func
+
+
+@Templater.register(ForEach)
+def templated_for_each_func(template: ForEach) -> TemplateFunc[list]:
+    """A list with a render of ``template.template`` per value of the parameter
+    ``template.param`` (see ``ForEach``).
+
+    >>> g = Templater.template_func(ForEach('xs', '{item}{sep}'), backend='closure')
+    >>> str(g.__signature__), g(xs=[1, 2], sep=';')
+    ('(*, xs, sep)', ['1;', '2;'])
+    """
+    param, item = template.param, template.item
+    params, item_template_func = get_generator_return(
+        Templater.template_func_generator(template.template)
+    )
+    params = tuple(dict.fromkeys(params))
+    outer_params = tuple(p for p in params if p != item)
+    yield param
+    yield from outer_params
+    uses_item = item in params
+
+    def template_func(**kwargs):
+        item_kwargs = {arg: kwargs[arg] for arg in outer_params}
+        if not uses_item:
+            return [item_template_func(**item_kwargs) for _ in kwargs[param]]
+        return [
+            item_template_func(**item_kwargs, **{item: value})
+            for value in kwargs[param]
+        ]
+
+    return template_func
+
+
+# the Templater handlers whose templates Compiler has handlers of its own for
+_compiled_handlers = {
+    templated_string_func,
+    templated_dict_func,
+    templated_list_func,
+    templated_constructed_func,
+    templated_include_func,
+    templated_for_each_func,
+}
+
+
+def template_fingerprint(template) -> Hashable:
+    """A hashable key identifying the structure and contents of ``template``, even if
+    it contains unhashable dicts, lists or sets.
+
+    >>> template_fingerprint({'a': ['{x}', 1]}) == template_fingerprint({'a': ['{x}', 1]})
+    True
+    >>> template_fingerprint(['{x}', 1]) == template_fingerprint(('{x}', 1))
+    False
+    >>> template_fingerprint([1]) == template_fingerprint([True])
+    False
+    >>> template_fingerprint([0.0]) == template_fingerprint([-0.0])
+    False
+    >>> template_fingerprint(ForEach('xs', ['{item}'])) == template_fingerprint(
+    ...     ForEach('xs', ['{item}'])
+    ... )
+    True
+
+    Dataclasses are identified by their fields. Other objects that are neither
+    hashable nor one of these containers are identified by their ``id``, so they
+    only match themselves.
+
+    >>> from dataclasses import dataclass
+    >>> @dataclass
+    ... class Point:
+    ...     x: list
+    >>> template_fingerprint(Point(['{x}'])) == template_fingerprint(Point(['{x}']))
+    True
+
+    The key is flat (a tuple of the keys of the nodes of ``template``, in
+    depth-first order), so templates can be nested deeper than the recursion limit.
+
+    >>> template = '{x}'
+    >>> for _ in range(5000):
+    ...     template = [template]
+    >>> template_fingerprint(template) == template_fingerprint(template)
+    True
+    """
+    fingerprint, stack = [], [template]
+    append, push, pop = fingerprint.append, stack.append, stack.pop
+    while stack:
+        template = pop()
+        template_type = type(template)
+        if template_type is str:
+            append((str, template))
+        elif isinstance(template, dict):
+            append((template_type, len(template)))
+            for k, v in reversed(template.items()):
+                push(v)
+                push(k)
+        elif isinstance(template, (list, tuple)):
+            append((template_type, len(template)))
+            stack.extend(reversed(template))
+        elif isinstance(template, (set, frozenset)):
+            items = frozenset(map(template_fingerprint, template))
+            append((template_type, items))
+        elif isinstance(template, ForEach):
+            append((template_type, template.param, template.item))
+            push(template.template)
+        elif isinstance(template, Dataclass) and not isinstance(template, type):
+            names = tuple(field.name for field in fields(template))
+            append((template_type, names))
+            stack.extend(getattr(template, name) for name in reversed(names))
+        else:
+            append(_leaf_fingerprint(template))
+    return tuple(fingerprint)
+
+
+def _leaf_fingerprint(template) -> Hashable:
+    try:
+        return exact_key(template)  # (tells 1 from True, and 0.0 from -0.0)
+    except TypeError:
+        pass
+    try:
+        hash(template)
+    except TypeError:
+        return type(template), id(template)
+    return type(template), template
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class TemplateFuncCache:
+    """An LRU cache of ``Templater.template_func`` results, keyed by the
+    ``template_fingerprint`` of the template (and the ``template_func`` options).
+
+    Calling the cache is like calling ``Templater.template_func``, but the template is
+    only compiled the first time its structure is seen.
+
+    >>> cache = TemplateFuncCache(maxsize=2)
+    >>> g = cache({'hello': '{name}'})
+    >>> g(name='you')
+    {'hello': 'you'}
+    >>> cache({'hello': '{name}'}) is g  # an equal template, loaded again
+    True
+    >>> cache({'hello': '{name}'}, backend='codegen') is g  # other options
+    False
+    >>> cache.cache_info()
+    CacheInfo(hits=1, misses=2, maxsize=2, currsize=2)
+    >>> cache.invalidate({'hello': '{name}'})
+    True
+    >>> cache.cache_info()
+    CacheInfo(hits=1, misses=2, maxsize=2, currsize=1)
+    >>> cache.cache_clear()
+    >>> cache.cache_info()
+    CacheInfo(hits=0, misses=0, maxsize=2, currsize=0)
+
+    Options can be unhashable:
+
+    >>> cache({'hello': '{name}'}, bound={'name': 'me'})()
+    {'hello': 'me'}
+
+    :param maxsize: The maximum number of compiled templates to keep (the least
+        recently used are evicted first), or ``None`` for no limit
+    :param templater: The ``Templater`` (class) whose ``template_func`` compiles
+    """
+
+    def __init__(self, maxsize: int = 256, templater=None):
+        self.maxsize = maxsize
+        self.templater = templater or Templater
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+
+    @staticmethod
+    def _key(template, template_func_kwargs):
+        # option values can be unhashable too (e.g. the ``bound`` dict)
+        options = (
+            (name, template_fingerprint(value))
+            for name, value in template_func_kwargs.items()
+        )
+        return template_fingerprint(template), tuple(sorted(options))
+
+    def __call__(self, template, **template_func_kwargs):
+        key = self._key(template, template_func_kwargs)
+        with self._lock:
+            func = self._cache.get(key)
+            if func is not None:
+                self._cache.move_to_end(key)
+                self._hits += 1
+                return func
+            self._misses += 1
+        func = self.templater.template_func(template, **template_func_kwargs)
+        with self._lock:
+            self._cache[key] = func
+            if self.maxsize is not None and len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return func
+
+    def invalidate(self, template, **template_func_kwargs) -> bool:
+        """Remove the entry of ``template`` (compiled with these options), returning
+        whether there was one"""
+        key = self._key(template, template_func_kwargs)
+        with self._lock:
+            return self._cache.pop(key, None) is not None
+
+    def cache_info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._hits = self._misses = 0
+
+
+# Templater.template_func, with a shared LRU cache of the compiled templates
+cached_template_func = TemplateFuncCache()